@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark
+---------
+
+Measures the operations of the *Folder* with each persistence backend as the
+ collections grow. A synthetic collection (boardgames that reference
+ designers) with text, int, image, reference and multivalue fields is
+ generated for every size, and the results are stored as JSON so two runs
+ can be compared:
+
+    python -m collector.core.benchmark run --sizes 1000 --output new.json
+    python -m collector.core.benchmark diff old.json new.json
+
+"""
+from collection import Folder
+from config import Config
+from persistence import PersistenceManager
+from schema import Schema
+from timeit import default_timer
+import argparse
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SIZES = [1000, 100000, 1000000]
+BACKENDS = ['pickle', 'sqlalchemy']
+# Words of the synthetic titles, the searched term is one of them
+WORDS = ['alpha', 'bravo', 'castle', 'dragon', 'empire', 'forest', 'galaxy',
+         'harbor', 'island', 'jungle', 'kingdom', 'legend', 'mystic',
+         'nomad', 'ocean', 'pirate', 'quest', 'river', 'spice', 'tower']
+TAGS = ['family', 'party', 'strategy', 'euro', 'wargame', 'abstract',
+        'cooperative', 'dice', 'cards', 'solo']
+
+SCHEMAS = {
+    'designers': {
+        'name': 'Designers',
+        'fields': {'name': {'name': 'name', 'index': True}}
+    },
+    'boardgames': {
+        'name': 'Boardgames',
+        'fields': {
+            'title': {'name': 'title'},
+            'year': {'name': 'year', 'class': 'int', 'index': True},
+            'cover': {'name': 'cover', 'class': 'image'},
+            'designer': {'name': 'designer', 'class': 'ref',
+                         'params': {'ref': 'designers.name'}},
+            'tags': {'name': 'tags', 'multiple': True}
+        }
+    }
+}
+
+
+class Benchmark(object):
+    """Runs the operations of each backend and collection size"""
+
+    COLLECTION = 'benchmark'
+    # Records saved by each call to save_many while the collection is built
+    BATCH = 1000
+    # Number of designers referenced by the boardgames
+    DESIGNERS = 100
+    # Number of calls of the operations that touch a single record
+    SAMPLE = 100
+
+    def __init__(self, sizes=None, backends=None, seed=0):
+        super(Benchmark, self).__init__()
+        self.sizes = sizes or SIZES
+        self.backends = backends or BACKENDS
+        self.seed = seed
+        self.results = []
+
+    def run(self):
+        """Runs all the benchmarks, returns the results document"""
+        # The images are stored as they are, the benchmark doesn't download
+        Config.get_instance().set('copy', 'never')
+        for backend in self.backends:
+            for size in self.sizes:
+                path = tempfile.mkdtemp(prefix='collector-benchmark-')
+                try:
+                    self.run_one(backend, size, path)
+                finally:
+                    shutil.rmtree(path, ignore_errors=True)
+        return self.document()
+
+    def run_one(self, backend, size, path):
+        """Runs the operations against a new collection of *size* records"""
+        rand = random.Random(self.seed)
+        designers, boardgames = self.create(backend, path)
+        designers.save_many(designers_data(self.DESIGNERS))
+        for start in range(0, size, self.BATCH):
+            count = min(self.BATCH, size - start)
+            data = boardgames_data(rand, start, count, self.DESIGNERS)
+            self.measure(backend, size, 'save_many', count,
+                         lambda: boardgames.save_many(data))
+        ids = [rand.randint(1, size) for _ in range(self.SAMPLE)]
+        term = rand.choice(WORDS)
+        new = boardgames_data(rand, size, self.SAMPLE, self.DESIGNERS)
+        operations = [
+            ('save', self.SAMPLE, lambda: [boardgames.save(data)
+                                           for data in new]),
+            ('get', self.SAMPLE, lambda: [boardgames.get(id_)
+                                          for id_ in ids]),
+            ('get_all', 1, lambda: boardgames.get_all(0, 0)),
+            ('get_all_page', 1, lambda: boardgames.get_all(size // 2, 100)),
+            ('get_last', 1, lambda: list(boardgames.get_last(100))),
+            ('search', 1, lambda: boardgames.search(term)),
+            ('filter_equals', 1, lambda: boardgames.filter(
+                [{'equals': ['year', 2000]}])),
+            ('filter_like', 1, lambda: boardgames.filter(
+                [{'like': ['title', term]}])),
+            ('filter_in', 1, lambda: boardgames.filter(
+                [{'in': ['year', [1990, 2000, 2010]]}]))
+        ]
+        for operation, count, function in operations:
+            self.measure(backend, size, operation, count, function)
+
+    def create(self, backend, path):
+        """Returns the empty folders of the synthetic collection"""
+        manager = PersistenceManager.get_instance()
+        folders = []
+        for id_ in ['designers', 'boardgames']:
+            schema = Schema(self.COLLECTION, id_, SCHEMAS[id_])
+            folders.append(Folder(id_, schema, manager.get_storage(
+                schema, backend, path)))
+        for folder in folders:
+            folder.persistence.all_created()
+        return folders
+
+    def measure(self, backend, size, operation, count, function):
+        """Runs *function* and adds its time to the results, the repeated
+         operations (save_many while the collection is built) are
+         accumulated. The results must be materialized by *function*,
+         the lazy queries aren't executed until they are iterated."""
+        start = default_timer()
+        function()
+        seconds = default_timer() - start
+        for result in self.results:
+            if (result['backend'], result['size'],
+                    result['operation']) == (backend, size, operation):
+                result['seconds'] += seconds
+                result['count'] += count
+                return
+        self.results.append({'backend': backend, 'size': size,
+                             'operation': operation, 'seconds': seconds,
+                             'count': count})
+
+    def document(self):
+        """Returns the results with the environment of the run"""
+        results = [dict(result, per_op=result['seconds'] / result['count'])
+                   for result in self.results]
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': self.seed,
+            'results': results
+        }
+
+
+def designers_data(count):
+    """Returns the data of *count* designers"""
+    return [{'name': 'Designer %d' % i} for i in range(count)]
+
+
+def boardgames_data(rand, start, count, designers):
+    """Returns the data of *count* boardgames, the numbers start at
+     *start*"""
+    data = []
+    for i in range(start, start + count):
+        data.append({
+            'title': '%s %s %d' % (rand.choice(WORDS), rand.choice(WORDS), i),
+            'year': rand.randint(1980, 2020),
+            'cover': 'http://example.com/covers/%d.jpg' % i,
+            'designer': rand.randint(1, designers),
+            'tags': rand.sample(TAGS, rand.randint(1, 3))
+        })
+    return data
+
+
+def diff(old, new, threshold=0.1):
+    """Compares two results documents, returns a list of (backend, size,
+     operation, old per_op, new per_op, ratio) sorted by ratio. The
+     operations slower than *threshold* (relative) are regressions."""
+    previous = dict(((result['backend'], result['size'],
+                      result['operation']), result['per_op'])
+                    for result in old['results'])
+    rows = []
+    for result in new['results']:
+        key = (result['backend'], result['size'], result['operation'])
+        if key not in previous or previous[key] == 0:
+            continue
+        ratio = result['per_op'] / previous[key]
+        rows.append(key + (previous[key], result['per_op'], ratio))
+    rows.sort(key=lambda row: row[-1], reverse=True)
+    regressions = [row for row in rows if row[-1] > 1 + threshold]
+    return rows, regressions
+
+
+def main(argv=None):
+    """Command line: *run* the benchmark or *diff* two results files,
+     diff exits with status 1 when there are regressions"""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='Runs the benchmark')
+    run.add_argument('--sizes', default=','.join(str(i) for i in SIZES),
+                     help='Comma separated collection sizes')
+    run.add_argument('--backends', default=','.join(BACKENDS),
+                     help='Comma separated persistence backends')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', help='JSON results file (default stdout)')
+    compare = commands.add_parser('diff', help='Compares two results files')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='Relative slowdown reported as regression')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        document = Benchmark([int(i) for i in args.sizes.split(',')],
+                             args.backends.split(','), args.seed).run()
+        output = json.dumps(document, indent=4, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as file_:
+                file_.write(output)
+        else:
+            print(output)
+        return 0
+    with open(args.old) as file_:
+        old = json.load(file_)
+    with open(args.new) as file_:
+        new = json.load(file_)
+    rows, regressions = diff(old, new, args.threshold)
+    for row in rows:
+        print("%-10s %8d %-14s %12.6f %12.6f %6.2fx" % row)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
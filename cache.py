@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Caches
+------
+
+Bounded caches that discard the least recently used entries.
+"""
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A dictionary with a maximum size, when it's full the least recently
+     used entry is removed. Counts the hits and misses of *get*."""
+
+    def __init__(self, maxsize=1000):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Returns the value for key, or *default* if it isn't cached"""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Move to the end, the most recently used
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches the value for key"""
+        self.remove(key)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._evict(self._data.popitem(last=False))
+
+    def remove(self, key):
+        """Removes the key from the cache"""
+        if key in self._data:
+            self._evict((key, self._data.pop(key)))
+
+    def _evict(self, item):
+        """Hook: called when an entry (key, value) is removed"""
+
+    def clear(self):
+        """Removes all the entries"""
+        self._data.clear()
+
+    def stats(self):
+        """Returns the counters of the cache as a dict"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class ReferenceCache(LRUCache):
+    """Cache value -> id for the lookups of references, the entries can be
+     invalidated by id when the referenced file changes"""
+
+    def __init__(self, maxsize=1000):
+        super(ReferenceCache, self).__init__(maxsize)
+        # id -> values
+        self._values = {}
+
+    def put(self, key, value):
+        super(ReferenceCache, self).put(key, value)
+        self._values.setdefault(value, set()).add(key)
+
+    def _evict(self, item):
+        key, id_ = item
+        values = self._values.get(id_, None)
+        if values is not None:
+            values.discard(key)
+            if not values:
+                del self._values[id_]
+
+    def discard_id(self, id_):
+        """Removes all the entries that point to the identifier *id_*"""
+        for key in list(self._values.get(id_, ())):
+            self.remove(key)
+
+    def clear(self):
+        super(ReferenceCache, self).clear()
+        self._values.clear()
@@ -4,18 +4,56 @@ of files."""
 from persistence import PersistenceManager
 from schema import Schema
 from config import Config
+from cache import ReferenceCache
+from ingest import IngestQueue, PENDING
+import functools
 import logging
 import os
+import Queue
+import threading
+import time
 
 
 class Folder(object):
     """Folder class"""
 
-    def __init__(self, id_, schema, persistence):
+    def __init__(self, id_, schema, persistence=None, opener=None):
+        """The *persistence* can be opened later, on the first access, by
+         calling *opener* with the folder."""
         super(Folder, self).__init__()
         self.id_ = id_
         self.schema = schema
-        self.persistence = persistence
+        self._persistence = persistence
+        self._opener = opener
+        # field -> ReferenceCache, the value -> id lookups of references
+        self.ref_caches = {}
+
+    @property
+    def persistence(self):
+        """The persistence of the folder, opened on the first access"""
+        return self.open()
+
+    @persistence.setter
+    def persistence(self, value):
+        self._persistence = value
+
+    @property
+    def lock(self):
+        """Serializes the access to the persistence, the entries are also
+         patched by the ingestion workers. The folders that share the
+         storage (e.g. one SQL session per collection) share the lock."""
+        return self.persistence.get_lock()
+
+    def is_open(self):
+        """Checks if the persistence of the folder has been opened"""
+        return self._persistence is not None
+
+    def open(self):
+        """Opens the persistence of the folder, if it isn't open, and
+         returns it"""
+        if self._persistence is None:
+            self._opener(self)
+        return self._persistence
 
     def get_id(self):
         """Returns the identifier of the folder"""
@@ -29,50 +67,186 @@ class Folder(object):
         """Returns the path of the representative image of the folder"""
         return self.schema.image
 
-    def get_last(self, limit=10):
+    def get_last(self, limit=10, loading=None):
         """ Finds last items created at the folder."""
-        return self.persistence.get_last(limit)
+        with self.lock:
+            return self.persistence.get_last(limit, loading)
 
     def get(self, id_):
         """Returns a file by id"""
-        return self.persistence.get(id_)
+        with self.lock:
+            return self.persistence.get(id_)
 
-    def get_all(self, start_at=0, limit=0, order=None):
+    def get_all(self, start_at=0, limit=0, order=None, loading=None):
         """ Finds all the items, optinally results could be called
-            using startAt and limit, useful for pagination.
+            using startAt and limit, useful for pagination. The *loading*
+            strategy for the references and multivalues is choosen by the
+            persistence if it isn't set.
+        """
+        with self.lock:
+            return self.persistence.get_all(start_at, limit, order, loading)
+
+    def iter_all(self, batch_size=100, order=None, loading=None):
+        """Generator of all the items, the items are loaded in batches of
+         *batch_size* so the memory doesn't grow with the folder size.
+        """
+        # The lock is held until the generator is exhausted or closed
+        with self.lock:
+            for item in self.persistence.iter_all(batch_size, order,
+                                                  loading):
+                yield item
+
+    def get_page(self, token=None, limit=100, order=None, loading=None):
+        """Returns a page of *limit* items and the continuation token for
+         the next page, or None if there aren't more pages. The *order*
+         must be the same for all the pages.
         """
-        return self.persistence.get_all(start_at, limit, order)
+        with self.lock:
+            return self.persistence.get_page(token, limit, order, loading)
+
+    def search(self, term, loading=None):
+        """Returns the items that matches the term"""
+        with self.lock:
+            return self.persistence.search(term, loading)
 
     def save(self, obj):
-        """Save the objet adding it to the file"""
-        copy = Config.get_instance().get('copy')
+        """Save the objet adding it to the file. If the setting *copy_async*
+         is enabled the remote files are added in background, meanwhile
+         the file fields have a pending placeholder."""
+        config = Config.get_instance()
+        pending = self._add_files(obj, config.get('copy'),
+                                  config.get('copy_async'))
+        with self.lock:
+            if 'id' in obj:
+                self._invalidate([obj['id']])
+            result = self.persistence.save(obj)
+        # Outside of the lock, the workers need it to patch the entries
+        self._ingest([obj['id']], [pending])
+        return result
+
+    def save_many(self, objs):
+        """Saves a group of objects at once, returns the list of
+         identifiers"""
+        config = Config.get_instance()
+        copy = config.get('copy')
+        objs = list(objs)
+        pending = [self._add_files(obj, copy, config.get('copy_async'))
+                   for obj in objs]
+        with self.lock:
+            self._invalidate([obj['id'] for obj in objs if 'id' in obj])
+            ids = self.persistence.save_many(objs)
+        self._ingest(ids, pending)
+        return ids
+
+    def _add_files(self, obj, copy, defer=False):
+        """Adds the files of the object to the collection following the
+         *copy* policy. If *defer* the remote files are replaced by a
+         placeholder and returned as a list of (field, url) to add them
+         later."""
+        pending = []
         for i in self.schema.file.values():
-            # Adding files to the collection
+            # Adding files to the collection
             if i.class_ == "image":
                 if i.is_multivalue():
                     raise Exception("Multivalue for images isn't"
                                     "supported")
+                if i.get_id() not in obj:
+                    continue
                 value = obj[i.get_id()]
-                # TODO multivalue support for files
+                if (defer and copy != 'never' and value is not None and
+                        value.startswith('http')):
+                    pending.append((i.get_id(), value))
+                    # The source is kept, the pending files can be retried
+                    obj[i.get_id()] = PENDING + value
+                    continue
+                # TODO multivalue support for files
                 value = self.persistence.addfile(value, copy)
                 if value is not None:
                     obj[i.get_id()] = value
+        return pending
+
+    def _ingest(self, ids, pending):
+        """Queues the deferred files of the saved objects, *pending* are
+         the lists returned by *_add_files* for each id"""
+        if not Config.get_instance().get('copy_async'):
+            return
+        queue = IngestQueue.get_instance()
+        copy = Config.get_instance().get('copy')
+        for id_, files in zip(ids, pending):
+            if id_ is None:
+                # Update of a missing entry, nothing to patch
+                continue
+            for field, url in files:
+                queue.submit(self, id_, field, url, copy)
 
-        return self.persistence.save(obj)
+    def retry_pending(self):
+        """Queues again the files whose entries still have the pending
+         placeholder, e.g. the ingestion was interrupted. Returns the
+         number of queued files."""
+        fields = [field.get_id() for field in self.schema.file.values()
+                  if field.class_ == 'image']
+        if not fields:
+            return 0
+        jobs = []
+        for item in self.iter_all(loading='lazy'):
+            for field in fields:
+                value = item[field]
+                if value and value.startswith(PENDING):
+                    jobs.append((item['id'], field, value[len(PENDING):]))
+        queue = IngestQueue.get_instance()
+        copy = Config.get_instance().get('copy')
+        for id_, field, url in jobs:
+            queue.submit(self, id_, field, url, copy)
+        return len(jobs)
+
+    def patch(self, id_, field, value):
+        """Sets the *field* of the entry *id_* to *value*, used by the
+         ingestion workers to replace the pending placeholders"""
+        with self.lock:
+            if self.persistence.get(id_) is None:
+                logging.info("Folder: entry %s deleted before the file %s "
+                             "was added", id_, value)
+                return
+            self.persistence.save({'id': id_, field: value})
 
     def delete(self, obj):
         """Deletes the objecte form the file"""
-        return self.persistence.delete(obj)
+        with self.lock:
+            self._invalidate([obj])
+            return self.persistence.delete(obj)
+
+    def delete_many(self, ids):
+        """Deletes all the objects whit identifier in *ids*"""
+        ids = list(ids)
+        with self.lock:
+            self._invalidate(ids)
+            return self.persistence.delete_many(ids)
+
+    def get_ref_cache(self, field):
+        """Returns the cache value -> id used to resolve the references
+         to the *field* of this folder"""
+        if field not in self.ref_caches:
+            size = Config.get_instance().get('ref_cache_size')
+            self.ref_caches[field] = ReferenceCache(size)
+        return self.ref_caches[field]
+
+    def _invalidate(self, ids):
+        """Removes the cached references to the files that will change"""
+        for cache in self.ref_caches.values():
+            for id_ in ids:
+                cache.discard_id(id_)
 
     def load_references(self, item):
         """Returns a copy of the object with all the references loaded"""
         man = Collection.get_instance()
-        return self.persistence.load_references(man, item)
+        with self.lock:
+            return self.persistence.load_references(man, item)
 
-    def filter(self, filters):
+    def filter(self, filters, loading=None):
         if not isinstance(filters, list):
             raise ValueError("Filter must be a dictionary")
-        return self.persistence.filter(filters)
+        with self.lock:
+            return self.persistence.filter(filters, loading)
 
 
 class Collection():
@@ -81,6 +255,8 @@ class Collection():
     # TODO Collection is not singleton and discover, is_collection...
     #  methods will go inside collector.Collector
     _instance = None
+    # Maximum number of collections loaded at the same time
+    LOAD_WORKERS = 8
 
     @staticmethod
     def get_instance(autodiscover=False):
@@ -97,8 +273,12 @@ class Collection():
         return os.path.isdir(item)
 
     def __init__(self, autodiscover=False):
+        # Storage and properties of the default collection
         self.storage = None
         self._raw = {}
+        # collection -> storage, properties
+        self.storages = {}
+        self.raws = {}
         if Collection._instance is not None:
             raise Exception('Called more than once')
         Collection._instance = self
@@ -111,69 +291,210 @@ class Collection():
 
     #TODO this method needs to be in the FrontController (aka. Collector)
     def load_collections(self, path):
-        """Looks in the choosed path for new collections"""
+        """Looks in the choosed path for collections, all of them are loaded
+         concurrently. The folders are identified by *collection/folder*"""
         allfiles = []
         collections = {}
         try:
-            allfiles = os.listdir(path)
+            allfiles = sorted(os.listdir(path))
         except Exception as error:
             logging.exception(error)
+        items = [item for item in allfiles
+                 if Collection.is_collection_folder(os.path.join(path, item))]
+        if not items:
+            return collections
+        start = time.time()
+        # The singleton must exists before the workers use it
+        PersistenceManager.get_instance()
+        results = self._load_concurrently(path, items)
+        for result in results:
+            if result is None:
+                continue
+            item, storage, raw, folders = result
+            self.storages[item] = storage
+            self.raws[item] = raw
+            for id_, folder in folders.items():
+                collections[item + '/' + id_] = folder
+            if self.storage is None:
+                # The first collection is the default one
+                self.storage = storage
+                self._raw = raw
+        logging.info("Collection: %d collections loaded in %.3fs",
+                     len(self.raws), time.time() - start)
+        return collections
 
+    def _load_concurrently(self, path, items):
+        """Loads the collections *items* using up to LOAD_WORKERS threads,
+         returns the results of *_load_collection* in the same order"""
+        if len(items) == 1:
+            return [self._load_collection(path, items[0])]
+        results = [None] * len(items)
+        jobs = Queue.Queue()
+        for job in enumerate(items):
+            jobs.put(job)
+
+        def work():
+            """Loads collections until there aren't more jobs"""
+            while True:
+                try:
+                    i, item = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = self._load_collection(path, item)
+
+        threads = [threading.Thread(target=work, name="load-%d" % i)
+                   for i in range(min(len(items), self.LOAD_WORKERS))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _load_collection(self, path, item):
+        """Loads the collection *item*, returns the tuple (item, storage,
+         properties, folders) or None if the collection isn't valid"""
+        start = time.time()
+        c_path = os.path.join(path, item)
+        try:
+            storage = PersistenceManager.load_schema(
+                c_path,
+                item,
+                readonly=False)
+            raw = storage.load()
+            persistence = raw['persistence']
+            schemas = raw['schemas']
+            folders = {}
+            # The persistences are opened when they are used
+            opener = functools.partial(self._open_folder, path=c_path,
+                                       persistence=persistence,
+                                       collections=folders,
+                                       lock=threading.RLock())
+            for id_ in schemas:
+                file_ = Schema(item, id_, schemas[id_])
+                folders[id_] = Folder(
+                    id_,
+                    file_,
+                    opener=opener)
+            preload = persistence.get('preload', [])
+            if preload is True:
+                preload = folders.keys()
+            for id_ in preload:
+                folders[id_].open()
+        except Exception as error:
+            logging.exception(error)
+            return None
+        logging.info("Collection %s: %d folders loaded in %.3fs", item,
+                     len(folders), time.time() - start)
+        return item, storage, raw, folders
+
+    @staticmethod
+    def _open_folder(folder, path, persistence, collections, lock):
+        """Opens the persistence of the folder and of the folders that it
+         references, they are needed to map the relations"""
         pers_man = PersistenceManager.get_instance()
-        for item in allfiles:
-            c_path = os.path.join(path, item)
-            if Collection.is_collection_folder(c_path):
-                self.storage = PersistenceManager.load_schema(
-                    c_path,
-                    item,
-                    readonly=False)
-                self._raw = self.storage.load()
-                raw = self._raw
-                persistence = raw['persistence']
-                schemas = raw['schemas']
-                for id_ in schemas:
-                    file_ = Schema(item, id_, schemas[id_])
-                    storage = pers_man.get_storage(
-                        file_,
-                        persistence['storage'],
-                        c_path
-                    )
-                    collection = Folder(
-                        id_,
-                        file_,
-                        storage)
-                    collections[id_] = collection
-                # TODO this notify must be a hook
-                for collection in collections.values():
-                    collection.persistence.all_created()
-                #TODO load more than one
-                return collections
-                # except Exception:
-                #     pass
-        return collections
+        with lock:
+            opening = []
+            pending = [folder]
+            while pending:
+                current = pending.pop()
+                if current.is_open() or current in opening:
+                    continue
+                opening.append(current)
+                for field in current.schema.file.values():
+                    if field.class_ == 'ref' and \
+                            field.ref_collection in collections:
+                        pending.append(collections[field.ref_collection])
+            for current in opening:
+                current.persistence = pers_man.get_storage(
+                    current.schema,
+                    persistence['storage'],
+                    path,
+                    persistence.get('params', None)
+                )
+            # TODO this notify must be a hook
+            for current in opening:
+                current.persistence.all_created()
+
+    def preload(self, ids=None):
+        """Opens the persistence of the folders with identifier in *ids*,
+         all the folders if *ids* is None. By default the folders are
+         opened on the first access. The identifiers are resolved like
+         *get_collection*, a KeyError is raised for the unknown or
+         ambiguous ones."""
+        if ids is None:
+            ids = self.collections.keys()
+        for id_ in ids:
+            self.get_collection(id_).open()
+
+    def collect_files(self):
+        """Removes the stored files that aren't used by any file of the
+         folders, returns the number of removed files. The files queued
+         by the ingestion are added and patched first, and the files
+         stored meanwhile are kept."""
+        start = time.time()
+        if IngestQueue._instance is not None:
+            IngestQueue._instance.flush()
+        stores = {}
+        for folder in self.collections.values():
+            store = folder.persistence.get_filestore()
+            uris = stores.setdefault(store.root, (store, []))[1]
+            images = [field.get_id() for field in folder.schema.file.values()
+                      if field.class_ == 'image']
+            if not images:
+                continue
+            for item in folder.iter_all(loading='lazy'):
+                for field in images:
+                    uris.append(item[field])
+        removed = 0
+        for store, uris in stores.values():
+            removed += len(store.collect(uris, start)[1])
+        return removed
+
+    def _get_raw(self, collection=None):
+        """Returns the properties of the collection, the default collection
+         if *collection* is None"""
+        if collection is None:
+            return self._raw
+        return self.raws[collection]
 
-    def get_persistence(self):
+    def get_persistence(self, collection=None):
         """Returns the persistence system of the Collection"""
-        return self._raw['persistence']['storage']
+        return self._get_raw(collection)['persistence']['storage']
 
-    def get_properties(self):
+    def get_properties(self, collection=None):
         """Rerturns all the properties"""
-        return self._raw
+        return self._get_raw(collection)
 
-    def get_property(self, key):
+    def get_property(self, key, collection=None):
         """Returns a property of the collection"""
-        return self._raw.get(key, None)
+        return self._get_raw(collection).get(key, None)
 
-    def get_collection(self, id_):
-        """Returns a Collection/Subcollection"""
+    def get_collection(self, id_, namespace=None):
+        """Returns a Collection/Subcollection, the identifier is
+         *collection/folder*. A folder identifier without collection is
+         looked up in the *namespace* collection or, if it isn't set, in
+         the collection that has it."""
+        if id_ not in self.collections and '/' not in id_:
+            if namespace is not None:
+                id_ = namespace + '/' + id_
+            else:
+                matches = [key for key in self.collections
+                           if key.split('/', 1)[1] == id_]
+                if len(matches) > 1:
+                    raise KeyError("Folder %s is ambiguous, use one of %s" %
+                                   (id_, ', '.join(sorted(matches))))
+                if len(matches) == 1:
+                    id_ = matches[0]
+        if id_ not in self.collections:
+            raise KeyError("Folder %s not found" % id_)
         return self.collections[id_]
 
-    def get_mapping(self, key):
+    def get_mapping(self, key, collection=None):
         """Returns the mapping for the requested key, is a shortcut to
          get_property('mappings')[key]"""
-        return self._raw['mappings'][key]
+        return self._get_raw(collection)['mappings'][key]
 
-    def set_properties(self, values):
+    def set_properties(self, values, collection=None):
         """Sets the properties of the collection, firts parameter is a
          dictionary and the allowed keys are:
             :title:    title of the  collection
@@ -181,13 +502,17 @@ class Collection():
             :description: description of the collection
         All the keys are optional
         """
+        raw = self._get_raw(collection)
         valid_properties = ['title', 'description', 'author', 'dashboard']
         for i in values.items():
             if i[0] in valid_properties:
-                self._raw[i[0]] = i[1]
-        self.commit()
+                raw[i[0]] = i[1]
+        self.commit(collection)
 
-    def commit(self):
+    def commit(self, collection=None):
         """Stores persistenctly if a Storage has been defined"""
-        if self.storage is not None:
-            self.storage.save(self._raw)
+        storage = self.storage
+        if collection is not None:
+            storage = self.storages[collection]
+        if storage is not None:
+            storage.save(self._get_raw(collection))
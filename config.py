@@ -58,6 +58,21 @@ class Config(object):
                         always    copy all the files
                         remote    only network files
                 """,
+        'copy_async': """Add the remote files of the new entries in
+                    background, the entries are saved at once""",
+        'copy_workers': "Number of threads that add files in background",
+        'ref_cache_size': """Maximum number of values cached for each
+                    referenced field, used to resolve the references
+                    of new files""",
+        'startup_log': "Log the timings of the startup phases",
+        'startup_allocations': """Measure the allocations of the startup
+                    phases (after config), it's slow without tracemalloc""",
+        'startup_stats': """File where the pstats of the startup are
+                    written (cProfile), empty to disable it""",
+        'sql_profile': """Time the SQL statements, see
+                    Alchemy.get_instance().profiler.report()""",
+        'sql_slow_query': """Seconds of the SQL statements that are logged
+                    as slow queries, 0 to disable it (needs sql_profile)""",
     }
 
     # Default settings
@@ -66,6 +81,14 @@ class Config(object):
         'plugins_enabled': [],
         'lang': ':system:',
         'copy': 'http',
+        'copy_async': False,
+        'copy_workers': 4,
+        'ref_cache_size': 10000,
+        'startup_log': False,
+        'startup_allocations': False,
+        'startup_stats': '',
+        'sql_profile': False,
+        'sql_slow_query': 1.0,
     }
 
     def __init__(self, platform=None):
@@ -10,10 +10,14 @@ The frontcontroller puts together the pieces of the core, offering a common
 More over offers shortcuts (methods) to acces to the more common properties,
  one of this shortcuts is *get_manager*
 """
+from collections import OrderedDict
 from collection import Collection, Folder
 from config import Config
 from persistence import PersistenceManager
 from plugin import PluginManager
+from ingest import IngestQueue
+from filestore import FileStore
+from profiling import StartupProfile
 import logging
 import os
 
@@ -27,37 +31,60 @@ class Collector(object):
     _instance = None
 
     managers = {}
+    # Maximum number of values for each reference lookup
+    IN_CHUNK = 500
 
     def __init__(self, home=None):
         if Collector._instance is not None:
             raise Exception("Called more than once")
         Collector._instance = self
         super(Collector, self).__init__()
+        # Timings of the startup phases
+        self.startup = StartupProfile()
         # Configuration
-        config = Config.get_instance()
-        self.add_manager('config', config)
-        if home is not None:
-            config.set_home(home)
+        with self.startup.phase('config'):
+            config = Config.get_instance()
+            self.add_manager('config', config)
+            if home is not None:
+                config.set_home(home)
+        if self.conf('startup_allocations'):
+            self.startup.enable_allocations()
+        stats = self.conf('startup_stats')
+        if stats:
+            self.startup.start_profiler()
 
-        if self.conf('build_user_dir'):
-            config.build_data_directory()
+        with self.startup.phase('data_directory'):
+            if self.conf('build_user_dir'):
+                config.build_data_directory()
 
         # Plug-ins
         sys_plugin_path = config.get_appdata_path()
         sys_plugin_path = os.path.join(sys_plugin_path, 'user_plugins')
 
         # System plug-ins
-        from collector.plugins import get_sys_plugins
-        plugins = get_sys_plugins()
-        # >= python 2.7
-        sys_plugins = {plugin.get_id(): plugin for plugin in plugins}
-        plugin_manager = PluginManager.get_instance(
-            self.conf('plugins_enabled'),
-            sys_plugins,
-            paths=[sys_plugin_path])
-        self.add_manager('plugin', plugin_manager)
-        self.add_manager('collection',
-                         Collection.get_instance(True))
+        with self.startup.phase('system_plugins'):
+            from collector.plugins import get_sys_plugins
+            plugins = get_sys_plugins()
+            # >= python 2.7
+            sys_plugins = {plugin.get_id(): plugin for plugin in plugins}
+        with self.startup.phase('plugins'):
+            plugin_manager = PluginManager.get_instance(
+                self.conf('plugins_enabled'),
+                sys_plugins,
+                paths=[sys_plugin_path])
+            self.add_manager('plugin', plugin_manager)
+        with self.startup.phase('collections'):
+            self.add_manager('collection',
+                             Collection.get_instance(True))
+        if stats:
+            self.startup.dump_stats(stats)
+        if self.conf('startup_log'):
+            self.startup.log()
+
+    def get_startup_profile(self):
+        """Returns the wall clock seconds and allocations of each phase of
+         the startup, see *profiling.StartupProfile.as_dict*"""
+        return self.startup.as_dict()
 
     @staticmethod
     def get_instance(params=None):
@@ -69,6 +96,9 @@ class Collector(object):
     @classmethod
     def shutdown(cls):
         Collector._instance = None
+        # Add the pending files before exit
+        IngestQueue.destroy()
+        FileStore.flush_all()
         # TODO delegate shutdown
 
     def conf(self, key):
@@ -98,48 +128,71 @@ class Collector(object):
         """Returns the results of the quick search for term in
          the selected collection"""
         collection = self.managers['collection'].get_collection(collection)
-        return collection.query(term)
+        return collection.search(term)
 
     def add(self, data, collection_id, use_mapping):
         """Adds a new file with fields *data* to the collection with id
          *collection_id* and uses the selected mapping"""
+        data = self._prepare([data], collection_id, use_mapping)[0]
+        collection = self.managers['collection'].get_collection(collection_id)
+        # Create the reduced and remaped data
+        return collection.save(data)
+
+    def add_many(self, datas, collection_id, use_mapping):
+        """Adds a group of files to the collection with id *collection_id*
+         using the selected mapping, the references of all the files are
+         resolved at once. Returns the identifiers of the new files."""
+        datas = self._prepare(datas, collection_id, use_mapping)
+        collection = self.managers['collection'].get_collection(collection_id)
+        return collection.save_many(datas)
+
+    def _prepare(self, datas, collection_id, use_mapping):
+        """Returns the *datas* remaped and with the values adapted to the
+         fields of the collection, the references are replaced by the
+         identifiers of the referenced files"""
         man = self.managers['collection']
-        mapping = man.get_mapping(use_mapping)
         collection = man.get_collection(collection_id)
-        data = self.remap(data, mapping)
+        namespace = collection.schema.collection
+        mapping = man.get_mapping(use_mapping, namespace)
         fields = collection.schema.file
-        for key in data:
-            if key in fields:
-                field = fields[key]
-                value = data[key]
-                if field.class_ == 'ref':
-                    ref = man.get_collection(field.ref_collection)
-                    refvalue = None
+        datas = [self.remap(data, mapping) for data in datas]
+        # values of each reference field
+        refs = {}
+        for data in datas:
+            for key in data.keys():
+                if key in fields:
+                    field = fields[key]
+                    value = data[key]
                     if field.is_multivalue():
-                        refvalue = []
-                        value = self.to_multivalue(value)
-                        for i in value:
-                            obj = self._get_or_create(ref, field.ref_field, i)
-                            refvalue.append(obj.id)
+                        data[key] = self.to_multivalue(value)
                     else:
-                        value = self.to_single(value)
-                        # Refvalue must be the id
-                        refvalue = self._get_or_create(
-                            ref,
-                            field.ref_field,
-                            value).id
-                    data[key] = refvalue
-                elif field.is_multivalue():
-                    data[key] = self.to_multivalue(value)
+                        data[key] = self.to_single(value)
+                    if field.class_ == 'ref':
+                        refs.setdefault(key, []).append(data)
                 else:
-                    data[key] = self.to_single(value)
-            else:
-                logging.info('Wrong mapper %s for collection %s, not found %s',
-                             use_mapping, collection_id, use_mapping)
-                del data[key]
-
-        # Create the reduced and remaped data
-        return collection.save(data)
+                    logging.info('Wrong mapper %s for collection %s, '
+                                 'not found %s',
+                                 use_mapping, collection_id, key)
+                    del data[key]
+        # Resolve the references, one lookup for each referenced field
+        for key, group in refs.items():
+            field = fields[key]
+            ref = man.get_collection(field.ref_collection, namespace)
+            values = []
+            for data in group:
+                if field.is_multivalue():
+                    values.extend(data[key])
+                else:
+                    values.append(data[key])
+            values = [value for value in values if value is not None]
+            ids = self._get_or_create_many(ref, field.ref_field, values)
+            for data in group:
+                # Refvalue must be the id
+                if field.is_multivalue():
+                    data[key] = [ids[i] for i in data[key] if i is not None]
+                elif data[key] is not None:
+                    data[key] = ids[data[key]]
+        return datas
 
     def complete(self, collection, id_, data, force=False):
         """Completes empty fields with the non empty keys from the new data.
@@ -214,18 +267,59 @@ class Collector(object):
                 data = None
         return data
 
-    @classmethod
-    def _get_or_create(cls, collection, key, value):
+    def _get_or_create(self, collection, key, value):
         """Looks if exists any entry that matches key==value, if not
          it creates one"""
         # If collection is not a Folder, assume is the identifier and load it
-        if collection is not type(Folder):
+        if not isinstance(collection, Folder):
             collection = self.managers['collection'].get_collection(collection)
+        cache = collection.get_ref_cache(key)
+        id_ = cache.get(value)
+        if id_ is not None:
+            obj = collection.get(id_)
+            if obj is not None:
+                return obj
+            cache.remove(value)
         exists = collection.filter([{'equals': [key, value]}])
         if len(exists) == 0:
-            return collection.save({key: value})
+            obj = collection.save({key: value})
         else:
-            return exists[0]
+            obj = exists[0]
+        cache.put(value, obj['id'])
+        return obj
+
+    def _get_or_create_many(self, collection, key, values):
+        """Returns a dict that maps each value to the identifier of the
+         entry where key==value, the entries that doesn't exists are
+         created. All the values are looked up in a few queries and the
+         new entries are saved at once."""
+        if not isinstance(collection, Folder):
+            collection = self.managers['collection'].get_collection(collection)
+        cache = collection.get_ref_cache(key)
+        ids = {}
+        lookup = []
+        # First seen order, the new entries get their ids in input order
+        for value in OrderedDict.fromkeys(values):
+            id_ = cache.get(value)
+            if id_ is None:
+                lookup.append(value)
+            else:
+                ids[value] = id_
+        values = lookup
+        for i in range(0, len(values), self.IN_CHUNK):
+            chunk = values[i:i + self.IN_CHUNK]
+            for obj in collection.filter([{'in': [key, chunk]}]):
+                # Like _get_or_create the first match wins
+                if obj[key] not in ids:
+                    ids[obj[key]] = obj['id']
+        missing = [value for value in values if value not in ids]
+        if missing:
+            created = collection.save_many([{key: value}
+                                            for value in missing])
+            ids.update(zip(missing, created))
+        for value in values:
+            cache.put(value, ids[value])
+        return ids
 
     @classmethod
     def remap(cls, data, mapping):
@@ -154,7 +154,10 @@ class FieldImage(Field):
         image = self.value
         if not image is None:
             uri = urlparse(self.value)
-            if uri.scheme == 'collector' and uri.netloc == 'collections':
+            if uri.scheme == 'collector' and uri.netloc == 'pending':
+                # The file is being added to the collection
+                image = None
+            elif uri.scheme == 'collector' and uri.netloc == 'collections':
                 image = os.path.join(Config.get_instance().get_home(),
                                      uri.netloc,
                                      os.path.normpath(uri.path[1:]))
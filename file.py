@@ -8,12 +8,37 @@ Each element of a collection is a file.
     This module name has the same name as the builtin function *file*.
 """
 import copy
+import keyword
+import re
+
+# Valid names for a slot
+SLOT = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Source of the __init__ generated for each FileSlots subclass, the slots
+#  are assigned directly instead of calling setattr for each field
+_SLOTS_INIT = """def __init__(self, fields):
+    assigned = 0
+%s    if assigned != len(fields):
+        self._set_extra(fields)
+"""
+_SLOTS_INIT_FIELD = """    if %(field)r in fields:
+        self.%(field)s = fields[%(field)r]
+        assigned += 1
+"""
+# Keywords can't be written as attributes
+_SLOTS_INIT_KEYWORD = """    if %(field)r in fields:
+        setattr(self, %(field)r, fields[%(field)r])
+        assigned += 1
+"""
 
 
 class File(object):
     """Marker for each item that must be a File. Be carefull this class isn't
      abstract (abc) to avoid errors with sqlalchemy."""
 
+    # Allows slotted subclasses, the subclasses without __slots__ will
+    #  have a __dict__ as usual
+    __slots__ = ()
     schema = None
 
     def get(self, field, load_reference=True):
@@ -58,3 +83,70 @@ class FileDict(File):
 
     def copy(self):
         return copy.deepcopy(self.__dict__.copy())
+
+
+class FileSlots(File):
+    """File that stores the fields in slots, it's lighter than FileDict
+     because there isn't a dictionary for each file. Don't use directly,
+     create a subclass for each schema with *FileSlots.subclass*. Fields
+     that aren't slots are stored into the __dict__ (created on demand)."""
+
+    __slots__ = ('__dict__',)
+    _fields = ()
+
+    def __init__(self, fields):
+        super(FileSlots, self).__init__()
+        for field in fields.items():
+            setattr(self, field[0], field[1])
+
+    def _set_extra(self, fields):
+        """Sets the *fields* that aren't slots"""
+        for key, value in fields.items():
+            if key not in self._fields:
+                setattr(self, key, value)
+
+    @classmethod
+    def subclass(cls, name, fields, attributes=None):
+        """Returns a new subclass with a slot for each field, the field
+         identifiers that can't be a slot are ignored. The subclass has its
+         own __init__ that sets all the slots in one pass."""
+        slots = tuple([str(field) for field in fields
+                       if SLOT.match(field) and not hasattr(cls, field)])
+        attrs = {'__slots__': slots, '_fields': cls._fields + slots}
+        # The names are valid identifiers (SLOT), safe to build the source
+        lines = []
+        for field in attrs['_fields']:
+            if keyword.iskeyword(field):
+                lines.append(_SLOTS_INIT_KEYWORD % {'field': field})
+            else:
+                lines.append(_SLOTS_INIT_FIELD % {'field': field})
+        source = _SLOTS_INIT % ''.join(lines)
+        namespace = {}
+        exec source in namespace
+        attrs['__init__'] = namespace['__init__']
+        if attributes is not None:
+            attrs.update(attributes)
+        return type(name, (cls,), attrs)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def _keys(self):
+        """Returns the name of all the fields with value"""
+        keys = [field for field in self._fields if hasattr(self, field)]
+        keys.extend(self.__dict__)
+        return keys
+
+    def update(self, fields):
+        for field in fields.items():
+            setattr(self, field[0], field[1])
+
+    def get(self, field, load_reference=True):
+        return self[field]
+
+    def copy(self):
+        return copy.deepcopy(dict([(key, getattr(self, key))
+                                   for key in self._keys()]))
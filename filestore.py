@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+File store
+----------
+
+Content-addressed storage for the files of a collection (images). Each file
+ is stored once, named by the hash of its content, inside sharded
+ subdirectories of the *files* folder of the collection:
+
+    files/ab/cd/abcd0123...
+
+"""
+from collections import OrderedDict, defaultdict
+from storage import AtomicJSONStorage
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+
+# Path of a blob relative to the files folder
+BLOB = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{40}$')
+
+
+class FileStore(object):
+    """Stores files by content, adding an existing content reuses the stored
+     file. The stored files are identified by *collector://* URIs."""
+
+    FOLDER = 'files'
+    CHUNK = 64 * 1024
+    _stores = {}
+
+    def __init__(self, path, collection_id):
+        super(FileStore, self).__init__()
+        self.path = path
+        self.root = os.path.join(path, self.FOLDER)
+        self.prefix = "collector://collections/%s/%s/" % (collection_id,
+                                                          self.FOLDER)
+        self._urlcache = None
+
+    @staticmethod
+    def flush_all():
+        """Saves the pending changes of the URL caches of all the stores"""
+        for store in FileStore._stores.values():
+            if store._urlcache is not None:
+                store._urlcache.flush()
+
+    @staticmethod
+    def get_instance(path, collection_id):
+        """Returns the store of the collection, all the persistences of a
+         collection share the same store"""
+        key = (path, collection_id)
+        if key not in FileStore._stores:
+            FileStore._stores[key] = FileStore(path, collection_id)
+        return FileStore._stores[key]
+
+    def get_urlcache(self):
+        """Returns the cache of the downloaded URLs"""
+        if self._urlcache is None:
+            self._urlcache = UrlCache(self.root)
+        return self._urlcache
+
+    def fetch(self, url):
+        """Downloads the URL and adds it to the store, returns its URI.
+        The URLs already downloaded are reused while they are fresh and
+         then revalidated using the ETag/Last-Modified headers."""
+        cache = self.get_urlcache()
+        entry = cache.get(url)
+        if entry is not None:
+            relative = self.get_relative(entry['uri'])
+            if relative is None or not self._touch(relative):
+                # The file was removed (garbage collector)
+                entry = None
+            elif time.time() - entry['fetched'] < cache.MAX_AGE:
+                return entry['uri']
+        request = urllib2.Request(url)
+        if entry is not None:
+            if entry.get('etag', None):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('modified', None):
+                request.add_header('If-Modified-Since', entry['modified'])
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as error:
+            if error.code == 304 and entry is not None and \
+                    self._touch(self.get_relative(entry['uri'])):
+                cache.put(url, entry['uri'], entry.get('etag', None),
+                          entry.get('modified', None))
+                return entry['uri']
+            raise
+        handle, tmp = tempfile.mkstemp()
+        dst = os.fdopen(handle, 'wb')
+        shutil.copyfileobj(response, dst, self.CHUNK)
+        dst.close()
+        info = response.info()
+        response.close()
+        uri = self.put(tmp, move=True)
+        cache.put(url, uri, info.get('ETag', None),
+                  info.get('Last-Modified', None))
+        return uri
+
+    def put(self, filename, move=False):
+        """Adds the file to the store and returns its URI. The content is
+         hashed while it's copied, if *move* is True the file is moved
+         instead of copied (useful for temporary files)."""
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        digest = hashlib.sha1()
+        if move:
+            tmp = None
+            src = open(filename, 'rb')
+            self._hash(src, digest)
+            src.close()
+        else:
+            handle, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+            dst = os.fdopen(handle, 'wb')
+            src = open(filename, 'rb')
+            self._hash(src, digest, dst)
+            src.close()
+            dst.close()
+        digest = digest.hexdigest()
+        relative = '/'.join([digest[0:2], digest[2:4], digest])
+        blob = self.get_path(relative)
+        if os.path.exists(blob):
+            # Same content, reuse the stored file
+            self._touch(relative)
+            if tmp is not None:
+                os.remove(tmp)
+            elif move:
+                os.remove(filename)
+        else:
+            folder = os.path.dirname(blob)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            if tmp is not None:
+                os.rename(tmp, blob)
+            else:
+                shutil.move(filename, blob)
+        return self.prefix + relative
+
+    def _touch(self, relative):
+        """Updates the modification time of a reused blob, so the garbage
+         collector running meanwhile keeps it. Returns False if the blob
+         doesn't exist."""
+        try:
+            os.utime(self.get_path(relative), None)
+        except OSError:
+            return False
+        return True
+
+    def _hash(self, src, digest, dst=None):
+        """Reads src updating the digest and writing to dst (if not None)"""
+        while True:
+            chunk = src.read(self.CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if dst is not None:
+                dst.write(chunk)
+
+    def get_path(self, relative):
+        """Returns the absolute path of a blob"""
+        return os.path.join(self.root, *relative.split('/'))
+
+    def get_relative(self, uri):
+        """Returns the path of the blob relative to the files folder, or
+         None if the URI isn't a blob of this store"""
+        if uri is None or not uri.startswith(self.prefix):
+            return None
+        relative = uri[len(self.prefix):]
+        if not BLOB.match(relative):
+            return None
+        return relative
+
+    def blobs(self):
+        """Returns the relative path of all the stored blobs"""
+        blobs = []
+        if not os.path.exists(self.root):
+            return blobs
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                relative = os.path.relpath(os.path.join(folder, name),
+                                           self.root)
+                relative = relative.replace(os.sep, '/')
+                if BLOB.match(relative):
+                    blobs.append(relative)
+        return blobs
+
+    def collect(self, uris, before=None):
+        """Garbage collector: removes the blobs not referenced by any of the
+         *uris* (all the URIs stored in the collection, repeated as many
+         times as they are used). The blobs stored or reused after the
+         timestamp *before* are kept, they can belong to entries saved
+         while the URIs were read. Returns the reference count of each
+         blob that is kept and the list of removed blobs."""
+        counts = defaultdict(int)
+        for uri in uris:
+            relative = self.get_relative(uri)
+            if relative is not None:
+                counts[relative] += 1
+        removed = []
+        for relative in self.blobs():
+            if counts.get(relative, 0) == 0:
+                try:
+                    path = self.get_path(relative)
+                    if before is not None and \
+                            os.path.getmtime(path) >= before:
+                        continue
+                    os.remove(path)
+                    removed.append(relative)
+                except OSError as error:
+                    logging.exception(error)
+        logging.info("FileStore: %d blobs removed from %s", len(removed),
+                     self.root)
+        return dict(counts), removed
+
+
+class UrlCache(object):
+    """Persistent cache url -> stored URI of the downloaded files, with the
+     validators (ETag, Last-Modified) of the download. The cache is
+     bounded, the least recently used URLs are discarded. The changes are
+     saved in batches, call *flush* to save the pending ones; losing them
+     only means downloading those URLs again."""
+
+    # Maximum number of URLs
+    MAXSIZE = 5000
+    # Seconds that a download is used without revalidation
+    MAX_AGE = 24 * 60 * 60
+    # The cache is saved after SAVE_EVERY changes or SAVE_INTERVAL seconds
+    #  since the last save
+    SAVE_EVERY = 50
+    SAVE_INTERVAL = 30
+
+    def __init__(self, path):
+        super(UrlCache, self).__init__()
+        self.storage = AtomicJSONStorage(path, 'urlcache')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._changes = 0
+        self._saved = time.time()
+        try:
+            entries = self.storage.load()
+        except ValueError as error:
+            logging.warning("UrlCache: ignoring corrupt cache %s (%s)",
+                            self.storage.file, error)
+            entries = None
+        if entries is not None:
+            for url, entry in sorted(entries.items(),
+                                     key=lambda item: item[1]['used']):
+                self._entries[url] = entry
+
+    def get(self, url):
+        """Returns the entry of the url or None"""
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is None:
+                return None
+            entry['used'] = time.time()
+            self._entries[url] = entry
+            return dict(entry)
+
+    def put(self, url, uri, etag=None, modified=None):
+        """Stores or refreshes the url entry"""
+        now = time.time()
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = {'uri': uri, 'etag': etag,
+                                  'modified': modified, 'fetched': now,
+                                  'used': now}
+            while len(self._entries) > self.MAXSIZE:
+                self._entries.popitem(last=False)
+            self._changes += 1
+            if self._changes >= self.SAVE_EVERY or \
+                    now - self._saved >= self.SAVE_INTERVAL:
+                self._save()
+
+    def flush(self):
+        """Saves the pending changes"""
+        with self._lock:
+            if self._changes:
+                self._save()
+
+    def _save(self):
+        """Writes the cache, the lock must be held"""
+        try:
+            self.storage.save(self._entries)
+        except (IOError, OSError) as error:
+            logging.exception(error)
+        self._changes = 0
+        self._saved = time.time()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+File ingestion
+--------------
+
+Downloads and copies the files of the new entries in background. The entry
+ is saved at once with a placeholder (*PENDING*) in the file field, a pool
+ of workers adds the files to the collection and, when a file is ready, the
+ worker patches the field with the final value (see *Folder.patch*).
+The placeholder is *PENDING* followed by the source URL, the files of an
+ interrupted ingestion can be queued again with *Folder.retry_pending*.
+"""
+from config import Config
+import logging
+import threading
+import Queue
+
+PENDING = 'collector://pending/'
+
+
+class IngestQueue(object):
+    """Bounded queue of files to add, processed by a pool of workers.
+    A file requested by several entries while it's being added is added
+     once, all the entries are patched with the same value."""
+
+    _instance = None
+    # Maximum number of files waiting for a worker, *submit* blocks when
+    #  the queue is full
+    QUEUE_SIZE = 100
+
+    def __init__(self, workers=4):
+        if IngestQueue._instance is not None:
+            raise Exception("Called more that once")
+        IngestQueue._instance = self
+        super(IngestQueue, self).__init__()
+        self.workers = workers
+        self._queue = Queue.Queue(self.QUEUE_SIZE)
+        self._threads = []
+        # (collection, source, mode) -> [(folder, id_, field)] of the files
+        #  queued or being added
+        self._inflight = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        """Returns the ingestion queue, the number of workers is the
+         setting *copy_workers*"""
+        if IngestQueue._instance is None:
+            IngestQueue._instance = IngestQueue(
+                Config.get_instance().get('copy_workers'))
+        return IngestQueue._instance
+
+    def submit(self, folder, id_, field, source, mode):
+        """Queues the file *source* to be added to the *folder* using the
+         copy *mode*, the *field* of the entry *id_* will be patched"""
+        self._start()
+        key = (folder.schema.collection, source, mode)
+        with self._lock:
+            self._pending += 1
+            waiters = self._inflight.get(key, None)
+            if waiters is not None:
+                waiters.append((folder, id_, field))
+                return
+            self._inflight[key] = [(folder, id_, field)]
+        self._queue.put((folder, key))
+
+    def _start(self):
+        """Starts the workers if they aren't running"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name="ingest-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """Worker loop: adds the files to the collection"""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            folder, key = job
+            source, mode = key[1:]
+            value = None
+            try:
+                value = folder.persistence.addfile(source, mode)
+            except Exception as error:
+                logging.exception(error)
+            if value is None:
+                # Keep the original value, better than a placeholder
+                value = source
+            self._complete(key, value)
+            self._queue.task_done()
+
+    def _complete(self, key, value):
+        """Patches the entries that are waiting for the file *key*"""
+        with self._lock:
+            waiters = self._inflight.pop(key)
+        for folder, id_, field in waiters:
+            try:
+                folder.patch(id_, field, value)
+            except Exception as error:
+                logging.exception(error)
+            with self._lock:
+                self._pending -= 1
+
+    def depth(self):
+        """Returns the number of files that aren't yet patched into
+         their entries"""
+        return self._pending
+
+    def flush(self):
+        """Waits until all the queued files are added and their entries
+         patched"""
+        self._queue.join()
+
+    def shutdown(self):
+        """Flushes the queue and stops the workers"""
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @staticmethod
+    def destroy():
+        """Shutdowns and destroys the instance"""
+        if IngestQueue._instance is not None:
+            IngestQueue._instance.shutdown()
+        IngestQueue._instance = None
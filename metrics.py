@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics
+-------
+
+Instrumentation of the persistence operations. The operations of every
+ *Persistence* class are wrapped by the metaclass *Instrumented*, when a
+ sink is registered each call reports its latency and the number of
+ returned items:
+
+    sink = MemorySink()
+    register_sink(sink)
+    ...
+    sink.stats()
+
+Without sinks the wrapper only checks the list of sinks. The calls made
+ inside another instrumented call (e.g. *delete* calling *delete_many*)
+ aren't reported.
+"""
+from abc import ABCMeta, abstractmethod
+from timeit import default_timer
+import functools
+import logging
+import threading
+
+# Operations of the persistences that are instrumented
+OPERATIONS = ('get', 'get_all', 'get_last', 'get_page', 'filter', 'search',
+              'save', 'save_many', 'delete', 'delete_many')
+
+_sinks = []
+_local = threading.local()
+
+
+def register_sink(sink):
+    """Registers a sink, all the persistence operations will be reported
+     to it"""
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def unregister_sink(sink):
+    """Removes the sink"""
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def get_sinks():
+    """Returns the registered sinks"""
+    return list(_sinks)
+
+
+def result_size(result):
+    """Returns the number of items of an operation result"""
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple):
+        # get_page returns (items, token)
+        return result_size(result[0])
+    return 1
+
+
+def instrument(operation, function):
+    """Returns the *function* wrapped to report the calls to the sinks"""
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if not _sinks or getattr(_local, 'depth', 0):
+            return function(self, *args, **kwargs)
+        _local.depth = 1
+        start = default_timer()
+        try:
+            result = function(self, *args, **kwargs)
+        finally:
+            _local.depth = 0
+        seconds = default_timer() - start
+        size = result_size(result)
+        for sink in list(_sinks):
+            try:
+                sink.record(type(self).__name__,
+                            getattr(self, 'subcollection', None),
+                            operation, seconds, size)
+            except Exception as error:
+                logging.exception(error)
+        return result
+    wrapper.instrumented = True
+    return wrapper
+
+
+class Instrumented(ABCMeta):
+    """Metaclass that instruments the OPERATIONS defined by the class"""
+
+    def __new__(mcs, name, bases, attributes):
+        for operation in OPERATIONS:
+            function = attributes.get(operation, None)
+            if callable(function) and \
+                    not getattr(function, 'instrumented', False) and \
+                    not getattr(function, '__isabstractmethod__', False):
+                attributes[operation] = instrument(operation, function)
+        return super(Instrumented, mcs).__new__(mcs, name, bases, attributes)
+
+
+class MetricsSink(object):
+    """Base class of the sinks"""
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def record(self, backend, folder, operation, seconds, size):
+        """Called after each operation of the persistence *backend* (class
+         name) for the *folder* with its latency and result size"""
+
+
+class MemorySink(MetricsSink):
+    """Keeps the metrics in memory: calls, latency histogram and returned
+     items for each backend and operation"""
+
+    # Upper bounds (seconds) of the latency histogram buckets, the last
+    #  bucket has the slower calls
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        super(MemorySink, self).__init__()
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def record(self, backend, folder, operation, seconds, size):
+        key = (backend, operation)
+        with self._lock:
+            metric = self._metrics.get(key, None)
+            if metric is None:
+                metric = {'calls': 0, 'seconds': 0.0, 'max': 0.0,
+                          'items': 0,
+                          'histogram': [0] * (len(self.BUCKETS) + 1)}
+                self._metrics[key] = metric
+            metric['calls'] += 1
+            metric['seconds'] += seconds
+            metric['max'] = max(metric['max'], seconds)
+            metric['items'] += size
+            bucket = len(self.BUCKETS)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    bucket = i
+                    break
+            metric['histogram'][bucket] += 1
+
+    def stats(self):
+        """Returns the metrics as a dict {backend: {operation: metric}}"""
+        stats = {}
+        with self._lock:
+            for (backend, operation), metric in self._metrics.items():
+                metric = dict(metric, histogram=list(metric['histogram']))
+                metric['mean'] = metric['seconds'] / metric['calls']
+                stats.setdefault(backend, {})[operation] = metric
+        return stats
+
+    def clear(self):
+        """Removes all the metrics"""
+        with self._lock:
+            self._metrics.clear()
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 """Persistence allows Collector to store the data in a persistence way"""
 
-from abc import ABCMeta, abstractmethod
-from storage import JSONStorage
-from file import FileDict
+from abc import abstractmethod
+from storage import JSONStorage, JSONJournalStorage
+from file import File, FileSlots
+from filter import Filter
+from textindex import TextIndex
+from filestore import FileStore
+from metrics import Instrumented
+import base64
+import json
 import logging
-import os
-import shutil
-import urllib
-import uuid
+import threading
 
 
 class Order(object):
@@ -20,10 +23,141 @@ class Order(object):
         self.fields = fields
 
 
+def encode_token(order, key=None, id_=None, offset=None):
+    """Returns the opaque continuation token of a page, the token is the
+     *key* (value of the ordered field) and the *id_* of the last entry
+     of the page or, for the backends without keyset support, the
+     *offset* of the next page"""
+    if order is not None:
+        order = [order.fields, order.asc]
+    return base64.urlsafe_b64encode(json.dumps(
+        {'order': order, 'key': key, 'id': id_, 'offset': offset}))
+
+
+def decode_token(token, order):
+    """Returns the continuation token as a dict, raises a ValueError if
+     the token isn't valid or it was created for another *order*"""
+    if order is not None and not isinstance(order, Order):
+        raise ValueError("Expected Order found %s" % type(order))
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid continuation token")
+    expected = None
+    if order is not None:
+        expected = [order.fields, order.asc]
+    if values.get('order', None) != expected:
+        raise ValueError("The continuation token is for another order")
+    return values
+
+
+class FilterDict(Filter):
+    """Marker for the PersistenceDict filters, the filters are compiled to
+     a python predicate that receives the item"""
+
+    @staticmethod
+    def compile(field, value, multivalue=False):
+        """Returns the predicate for the field and value"""
+
+
+class FilterDictEquals(FilterDict):
+    """The equivalence filter"""
+
+    @staticmethod
+    def get_id():
+        return 'equals'
+
+    @staticmethod
+    def get_description():
+        return "An equivalence relationship"
+
+    @staticmethod
+    def get_name():
+        return "="
+
+    @staticmethod
+    def get_filter(params):
+        return FilterDictEquals.compile(*params)
+
+    @staticmethod
+    def compile(field, value, multivalue=False):
+        if multivalue:
+            return lambda item: value in (item.get(field) or ())
+        return lambda item: item.get(field, None) == value
+
+
+def _text(value):
+    """Returns the value as unicode, the byte strings are UTF-8"""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+class FilterDictLike(FilterDict):
+    """The like filter, as the SQL LIKE is case insensitive"""
+
+    @staticmethod
+    def get_id():
+        return 'like'
+
+    @staticmethod
+    def get_description():
+        return "Looks if a text is containet into another"
+
+    @staticmethod
+    def get_name():
+        return "contains"
+
+    @staticmethod
+    def get_filter(params):
+        return FilterDictLike.compile(*params)
+
+    @staticmethod
+    def compile(field, value, multivalue=False):
+        value = _text(value).lower()
+
+        def contains(text):
+            """Checks if value is inside text"""
+            return text is not None and value in _text(text).lower()
+
+        if multivalue:
+            return lambda item: any(contains(i)
+                                    for i in (item.get(field) or ()))
+        return lambda item: contains(item.get(field, None))
+
+
+class FilterDictIn(FilterDict):
+    """The membership filter, the value must be a list"""
+
+    @staticmethod
+    def get_id():
+        return 'in'
+
+    @staticmethod
+    def get_description():
+        return "Looks if a value is one of a list"
+
+    @staticmethod
+    def get_name():
+        return "in"
+
+    @staticmethod
+    def get_filter(params):
+        return FilterDictIn.compile(*params)
+
+    @staticmethod
+    def compile(field, value, multivalue=False):
+        values = set(value)
+        if multivalue:
+            return lambda item: not values.isdisjoint(item.get(field) or ())
+        return lambda item: item.get(field, None) in values
+
+
 class Persistence(object):
-    """Abstract class for Persitence"""
+    """Abstract class for Persitence, the operations of all the
+     persistences report to the metrics sinks (see metrics)"""
 
-    __metaclass__ = ABCMeta
+    __metaclass__ = Instrumented
 
     def __init__(self, schema, path, params=None):
         super(Persistence, self).__init__()
@@ -34,66 +168,118 @@ class Persistence(object):
         self.collection_id = schema.collection
         self.subcollection = schema.id
         self.params = params
+        self._filestore = None
+        self._lock = threading.RLock()
+
+    def get_lock(self):
+        """Returns the lock that serializes the access to the storage of
+         the persistence, the backends that share the storage between
+         folders share the lock too"""
+        return self._lock
 
     def addfile(self, filename, mode):
         """Persists a file, it will add to the storage if mode is always or
          if mode is *http* will copy only http resources. Also exists a
-         *never* mode."""
-        if mode == 'never':
+         *never* mode. The files are stored by content, so a file added
+         twice is stored once."""
+        if mode == 'never' or filename.startswith('collector://'):
             return filename
-        http = False
-        if filename.startswith('http'):
-            filename, headers = urllib.urlretrieve(filename)
-            http = True
+        http = filename.startswith('http')
         if not http and mode == 'http':
             return filename
-        dst = os.path.join(self.path, "files", str(uuid.uuid4()))
         try:
-            folder = os.path.join(self.path, "files")
-            if not os.path.exists(folder):
-                os.mkdir(folder)
-            shutil.copyfile(filename, dst)
-            dst = dst.replace(self.path, '')
-            dst = "collector://collections/" + self.collection_id + "/" + dst
-
-        except IOError as ioex:
+            if http:
+                # The URLs are cached, repeated URLs aren't downloaded
+                return self.get_filestore().fetch(filename)
+            return self.get_filestore().put(filename)
+        except (IOError, OSError) as ioex:
             logging.exception(ioex)
             return None
-        return dst
+
+    def get_filestore(self):
+        """Returns the store of the files of the collection"""
+        if self._filestore is None:
+            self._filestore = FileStore.get_instance(self.path,
+                                                     self.collection_id)
+        return self._filestore
 
     @abstractmethod
     def delete(self, _id):
         """Deletes the entry whit identifier *_id*"""
 
     @abstractmethod
-    def filter(self, filters):
-        """Applies a set of filters before retrieve the data"""
+    def filter(self, filters, loading=None):
+        """Applies a set of filters before retrieve the data. The
+         *loading* parameter, accepted by all the queries, is the strategy
+         to load the references and multivalues of the results
+         ('lazy', 'selectin', 'joined') for the backends that need it."""
 
     @abstractmethod
     def get(self, _id):
         """Returns the entry whit identifier *id*"""
 
     @abstractmethod
-    def get_all(self, start_at, limit, order=None):
+    def get_all(self, start_at, limit, order=None, loading=None):
         """Returns all the entrys, allows pagination with *start_at* and
          *limit*"""
 
+    def iter_all(self, batch_size=100, order=None, loading=None):
+        """Generator of all the entries, the entries are loaded in
+         batches of *batch_size*. Backends should override it to avoid
+         the pagination."""
+        start_at = 0
+        while True:
+            batch = self.get_all(start_at, batch_size, order, loading)
+            for item in batch:
+                yield item
+            if len(batch) < batch_size:
+                break
+            start_at += batch_size
+
+    def get_page(self, token=None, limit=100, order=None, loading=None):
+        """Returns a page of *limit* entries and the continuation token
+         of the next page (None if it's the last page). The first page is
+         requested without *token*. Backends should override it with a
+         keyset pagination, this one uses offsets."""
+        start_at = 0
+        if token is not None:
+            start_at = decode_token(token, order)['offset']
+        items = self.get_all(start_at, limit + 1, order, loading)
+        if len(items) <= limit:
+            return items, None
+        return items[:limit], encode_token(order, offset=start_at + limit)
+
     @abstractmethod
     def get_filters(self):
         """Returns all the avaible filters"""
 
     @abstractmethod
-    def get_last(self, count):
+    def get_last(self, count, loading=None):
         """Returns the last inserted items, maximum *count*"""
 
     @abstractmethod
-    def search(self, term):
+    def search(self, term, loading=None):
         """Search entry who match the parameter term"""
 
     @abstractmethod
     def save(self, values):
         """Saves the values if they have a valid id or creates a new entry"""
 
+    def save_many(self, values):
+        """Saves a group of entries, returns the identifier of each entry,
+         in the same order, or None for the updates of missing entries.
+        Backends should override it to store all the entries at once."""
+        ids = []
+        for item in values:
+            saved = self.save(item)
+            ids.append(saved['id'] if saved is not None else None)
+        return ids
+
+    def delete_many(self, ids):
+        """Deletes all the entries whit identifier in *ids*"""
+        for _id in ids:
+            self.delete(_id)
+
     @abstractmethod
     def load_references(self, collections, item):
         """Loads all the referenced values"""
@@ -106,14 +292,33 @@ class PersistenceDict(Persistence):
     """Implementation of persistence using a python dictionary"""
 
     _autoid = 1
+    filters = {
+        'equals': FilterDictEquals(),
+        'like': FilterDictLike(),
+        'in': FilterDictIn()
+    }
 
     def __init__(self, schema, path, params=None):
         super(PersistenceDict, self).__init__(schema, path, params)
-        self.items = []
+        # The stored items, the deleted ones are left as None (tombstones)
+        #  until the next access to self.items
+        self._items = []
+        # Position of the first tombstone, None if there aren't
+        self._first_deleted = None
+        # Maps each id to the position of its item inside self._items
+        self._index = {}
+        # Secondary indexes, for each indexed field maps value -> ids
+        self._field_indexes = {}
+        # Full text index, it's built on the first search
+        self._text_index = None
+        # Sorted items by order, the cache is cleared on every change
+        self._sorted = {}
         self.data_storage = None
         self.memory = False
-        self.class_ = type(str(schema.collection + "_" + schema.id),
-                           (FileDict,), {"schema": schema.id})
+        self.class_ = FileSlots.subclass(
+            str(schema.collection + "_" + schema.id),
+            ['id'] + list(schema.file),
+            {"schema": schema.id})
         # configure
         self.configure()
 
@@ -126,34 +331,183 @@ class PersistenceDict(Persistence):
         self.memory = params.get('memory', False)
         data = params.get('data', None)
         if self.path is not None:
-            self.data_storage = JSONStorage(
-                self.path,
-                self.subcollection,
-                self.memory)
+            if params.get('journal', False):
+                self.data_storage = JSONJournalStorage(
+                    self.path,
+                    self.subcollection,
+                    self.memory,
+                    params.get('journal_threshold', 1000),
+                    params.get('journal_background', True))
+            else:
+                self.data_storage = JSONStorage(
+                    self.path,
+                    self.subcollection,
+                    self.memory)
             self.items = self.data_storage.load()
             if self.items is None:
                 self.items = []
         if data is not None:
             self.items = data
 
+        self._build_index()
+        self._build_field_indexes()
         self._calc_autoid()
 
+    @property
+    def items(self):
+        """The list of stored items, the deleted items are removed from
+         the list on the first access after the deletion"""
+        if self._first_deleted is not None:
+            self._compact()
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+        self._first_deleted = None
+
+    def _compact(self):
+        """Removes the tombstones, only the items after the first one are
+         displaced"""
+        first = self._first_deleted
+        self._first_deleted = None
+        self._items[first:] = [item for item in self._items[first:]
+                               if item is not None]
+        self._build_index(first)
+
+    def _build_index(self, start_at=0):
+        """(Re)builds the id index for the items from position
+         *start_at* until the end"""
+        index = self._index
+        if start_at == 0:
+            index.clear()
+        items = self._items
+        for pos in xrange(start_at, len(items)):
+            index[items[pos]['id']] = pos
+
+    def _build_field_indexes(self):
+        """Builds the indexes of the fields marked as indexed at the
+         schema"""
+        self._field_indexes = dict([(field, {})
+                                    for field in self.schema.indexes])
+        if self._field_indexes:
+            for item in self.items:
+                self._index_item(item)
+
+    def _index_item(self, item, add=True):
+        """Adds (or removes if *add* is False) the item to the secondary
+         indexes"""
+        for field, index in self._field_indexes.items():
+            if field not in item:
+                continue
+            values = item[field]
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                try:
+                    if add:
+                        index.setdefault(value, set()).add(item['id'])
+                    elif value in index:
+                        index[value].discard(item['id'])
+                        if not index[value]:
+                            del index[value]
+                except TypeError:
+                    # Unhashable values can't be indexed
+                    pass
+
+    def _position(self, _id):
+        """Returns the position of the item with identifier *_id* or None
+         if it doesn't exists"""
+        if isinstance(_id, basestring):
+            _id = int(_id)
+        return self._index.get(_id, None)
+
     def _calc_autoid(self):
         """Searchs the max id used and set's the new autoid value"""
         maxid = 0
-        for i in self.items:
-            maxid = max(maxid, i['id'])
+        if self._index:
+            maxid = max(self._index)
         self._autoid = maxid + 1
 
-    def filter(self, fitlers):
-        # TODO
-        raise Exception("Not Implemented")
+    def filter(self, filters, loading=None):
+        candidates, predicate = self.compile_filters(filters)
+        if candidates is None:
+            items = self.items
+        else:
+            items = [self._items[pos] for pos in sorted(candidates)]
+        return [self.class_(item) for item in items if predicate(item)]
+
+    def compile_filters(self, filters):
+        """Compiles the filters, returns the positions of the candidate
+         items (or None if all the items are candidates) and the predicate
+         that the candidates must match"""
+        candidates = None
+        predicates = []
+        for filter_ in filters:
+            for i in filter_:
+                if i not in self.filters:
+                    continue
+                field, value = filter_[i]
+                positions = None
+                if i == 'equals':
+                    positions = self._lookup(field, value)
+                elif i == 'in':
+                    positions = self._lookup_many(field, value)
+                if positions is not None:
+                    if candidates is None:
+                        candidates = positions
+                    else:
+                        candidates = candidates & positions
+                    continue
+                multivalue = (field in self.schema.file and
+                              self.schema.get_field(field).is_multivalue())
+                predicates.append(
+                    self.filters[i].compile(field, value, multivalue))
+        return candidates, self._all(predicates)
+
+    @staticmethod
+    def _all(predicates):
+        """Returns a predicate that matches when all the *predicates*
+         match"""
+        if len(predicates) == 0:
+            return lambda item: True
+        elif len(predicates) == 1:
+            return predicates[0]
+        return lambda item: all(pred(item) for pred in predicates)
+
+    def _lookup(self, field, value):
+        """Returns the set of positions of the items where *field* is
+         equal to *value* using the indexes, or None if the field
+         isn't indexed"""
+        if field == 'id':
+            try:
+                pos = self._position(value)
+            except ValueError:
+                pos = None
+            return set() if pos is None else set([pos])
+        if field in self._field_indexes:
+            try:
+                ids = self._field_indexes[field].get(value, ())
+            except TypeError:
+                return None
+            return set([self._index[_id] for _id in ids])
+        return None
+
+    def _lookup_many(self, field, values):
+        """Returns the set of positions of the items where *field* is
+         one of the *values*, or None if the field isn't indexed"""
+        positions = set()
+        for value in values:
+            found = self._lookup(field, value)
+            if found is None:
+                return None
+            positions.update(found)
+        return positions
 
     def get_filters(self):
-        #TODO
-        return []
+        return self.filters
 
-    def get_last(self, count):
+    def get_last(self, count, loading=None):
         """Returns the last items created, the number of items are defined
          with the count parameter, the items are orderded by last inserted"""
         result = self.items[-count:]
@@ -161,18 +515,16 @@ class PersistenceDict(Persistence):
         objects = []
         result.reverse()
         for item in result:
-            objects.append(FileDict(item))
+            objects.append(self.class_(item))
         return objects
 
     def get(self, _id):
-        if isinstance(_id, str):
-            _id = int(_id)
-        for item in self.items:
-            if _id == item['id']:
-                return FileDict(item)
-        return None
+        pos = self._position(_id)
+        if pos is None:
+            return None
+        return self.class_(self._items[pos])
 
-    def get_all(self, start_at, limit, order=None):
+    def get_all(self, start_at, limit, order=None, loading=None):
         """Returns all the items starting at *start_at*, the results could
          be limited whit *limit*"""
         result = []
@@ -182,37 +534,203 @@ class PersistenceDict(Persistence):
         else:
             objects = self.items[start_at:(start_at + limit)]
         for item in objects:
-            result.append(FileDict(item))
+            result.append(self.class_(item))
         return result
 
-    def search(self, term):
-        results = []
-        term = term.lower()
+    def iter_all(self, batch_size=100, order=None, loading=None):
+        """Generator of all the items, the list of items is sliced in
+         batches of *batch_size* as the generator advances"""
+        start_at = 0
+        while start_at < len(self.items):
+            for item in self.items[start_at:(start_at + batch_size)]:
+                yield self.class_(item)
+            start_at += batch_size
+
+    def get_page(self, token=None, limit=100, order=None, loading=None):
+        """Returns a page of items and the token of the next page, the
+         page starts after the last item of the previous page, so
+         changes in the items don't move the following pages"""
+        last = None
+        if token is not None:
+            last = decode_token(token, order)
+        if order is None:
+            items = self.items
+            start_at = 0
+            if last is not None:
+                start_at = self._after_id(last['id'])
+        else:
+            keys, items = self._sorted_items(order)
+            start_at = 0
+            if last is not None:
+                start_at = self._after_key(keys, (last['key'], last['id']),
+                                           order.asc)
+        page = items[start_at:(start_at + limit)]
+        result = [self.class_(item) for item in page]
+        if start_at + limit >= len(items):
+            return result, None
+        key = None
+        if order is not None:
+            key = page[-1].get(order.fields, None)
+        return result, encode_token(order, key, page[-1]['id'])
+
+    def _after_id(self, _id):
+        """Returns the position after the item with id *_id*, the items
+         are sorted by id because the ids are incremental"""
+        pos = self._position(_id)
+        if pos is not None:
+            return pos + 1
+        # The item was deleted, binary search of the next id
+        low, high = 0, len(self.items)
+        while low < high:
+            mid = (low + high) // 2
+            if self.items[mid]['id'] <= _id:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    @staticmethod
+    def _after_key(keys, key, ascending):
+        """Returns the position after *key* inside the sorted *keys*"""
+        low, high = 0, len(keys)
+        while low < high:
+            mid = (low + high) // 2
+            if (keys[mid] <= key) if ascending else (keys[mid] >= key):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _sorted_items(self, order):
+        """Returns the sort keys (value, id) and the items sorted
+         by *order*"""
+        if not isinstance(order, Order):
+            raise ValueError("Expected Order found %s" % type(order))
+        cache_key = (order.fields, order.asc)
+        if cache_key not in self._sorted:
+            field = order.fields
+            items = sorted(self.items,
+                           key=lambda item: (item.get(field, None),
+                                             item['id']),
+                           reverse=not order.asc)
+            keys = [(item.get(field, None), item['id']) for item in items]
+            self._sorted[cache_key] = (keys, items)
+        return self._sorted[cache_key]
+
+    def search(self, term, loading=None):
+        """Returns the items with text fields that contains all the words
+         of *term*, the last words could be incomplete. The results are
+         ranked, the best first."""
+        if self._text_index is None:
+            self._build_text_index()
+        ids = self._text_index.search(term)
+        if ids is None:
+            return [self.class_(item) for item in self.items]
+        return [self.class_(self._items[self._index[_id]]) for _id in ids]
+
+    def _build_text_index(self):
+        """Builds the full text index with all the text fields"""
+        self._text_index = TextIndex()
         for item in self.items:
-            if item['title'].lower().find(term) != -1:
-                results.append(FileDict(item))
-        return results
+            self._text_index.add(item['id'], self._texts(item))
+
+    def _texts(self, item):
+        """Returns the values of the text fields of the item"""
+        texts = []
+        for field in self.schema.file.values():
+            if field.class_ != 'text':
+                continue
+            value = item.get(field.get_id(), None)
+            if isinstance(value, list):
+                texts.extend(value)
+            elif value is not None:
+                texts.append(value)
+        return texts
 
     def save(self, values):
+        item = self._save(values)
+        if item is None:
+            return None
+        self.commit([{'op': 'save', 'item': item}])
+        return self.class_(item)
+
+    def save_many(self, values):
+        records = []
+        ids = []
+        for value in values:
+            item = self._save(value)
+            if item is None:
+                ids.append(None)
+                continue
+            records.append({'op': 'save', 'item': item})
+            ids.append(item['id'])
+        if records:
+            self.commit(records)
+        return ids
+
+    def _save(self, values):
+        """Updates or inserts the values without commit, returns the
+         stored item or None if the id doesn't exists"""
+        if isinstance(values, File):
+            values = values.copy()
         if 'id' in values:
-            for item in self.items:
-                if values['id'] == item['id']:
-                    item.update(values)
+            pos = self._position(values['id'])
+            if pos is None:
+                return None
+            item = self._items[pos]
+            id_ = item['id']
+            self._index_item(item, False)
+            item.update(values)
+            # The id keeps its type, *values* can have it as a string
+            item['id'] = id_
         else:
-            values['id'] = self._autoid
+            item = values
+            item['id'] = self._autoid
             self._autoid += 1
-            self.items.append(values)
-        self.commit()
+            self._index[item['id']] = len(self._items)
+            self._items.append(item)
+        self._index_item(item)
+        self._sorted.clear()
+        if self._text_index is not None:
+            self._text_index.add(item['id'], self._texts(item))
+        return item
 
     def delete(self, _id):
-        for item in self.items:
-            if item['id'] == _id:
-                self.items.remove(item)
-        self.commit()
+        self.delete_many([_id])
+
+    def delete_many(self, ids):
+        records = []
+        for _id in ids:
+            pos = self._position(_id)
+            if pos is None:
+                continue
+            item = self._items[pos]
+            _id = item['id']
+            self._index_item(item, False)
+            if self._text_index is not None:
+                self._text_index.remove(_id)
+            del self._index[_id]
+            # Tombstone, the list is compacted on the next access to
+            #  self.items so consecutive deletes don't move the items
+            self._items[pos] = None
+            records.append({'op': 'delete', 'id': _id})
+            if self._first_deleted is None or pos < self._first_deleted:
+                self._first_deleted = pos
+        if not records:
+            return
+        self._sorted.clear()
+        self.commit(records)
 
-    def commit(self):
-        """Stores the changes"""
-        if self.data_storage is not None:
+    def commit(self, records=None):
+        """Stores the changes, if the storage is a journal only the
+         *records* of the changes are appended"""
+        if self.data_storage is None:
+            return
+        if records is not None and isinstance(self.data_storage,
+                                              JSONJournalStorage):
+            if self.data_storage.append(records):
+                self.data_storage.compact(self.items)
+        else:
             self.data_storage.save(self.items)
 
     def load_references(self, collections, item):
@@ -234,11 +752,11 @@ class PersistenceManager(object):
             raise Exception('Called more that once')
 
         super(PersistenceManager, self).__init__()
-        from persistence_sql import PersistenceAlchemy
-
+        # The backends are imported the first time that are used, the
+        #  sqlalchemy backend is slow to import
         self.storages = {
             'pickle': PersistenceDict,
-            'sqlalchemy': PersistenceAlchemy
+            'sqlalchemy': 'persistence_sql.PersistenceAlchemy'
         }
 
     @staticmethod
@@ -246,9 +764,26 @@ class PersistenceManager(object):
         """Returns an schema represented as a python dict"""
         return JSONStorage(path, collection, readonly)
 
+    def register_storage(self, id_, storage):
+        """Registers the persistence backend *id_*, *storage* is the
+         Persistence class or its import path (module.Class), then the
+         module is imported when the backend is used"""
+        self.storages[id_] = storage
+
+    def get_storage_class(self, storage):
+        """Returns the persistence class of the backend *storage*"""
+        class_ = self.storages[storage]
+        if isinstance(class_, basestring):
+            module, classname = class_.rsplit('.', 1)
+            temp = __import__(module, globals(), locals(),
+                              fromlist=[classname])
+            class_ = getattr(temp, classname)
+            self.storages[storage] = class_
+        return class_
+
     def get_storage(self, schema, storage, path, params=None):
         """Returns the persistence class that matches the parameters"""
-        return self.storages[storage](schema, path, params)
+        return self.get_storage_class(storage)(schema, path, params)
 
     @staticmethod
     def get_instance():
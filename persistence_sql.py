@@ -2,16 +2,26 @@
 """PersistenceAlchemy allows Collector to store the data using SQLAlchemy"""
 
 # Take a look to dictionary collections p.95 true page: 109
-from persistence import Persistence, Order
+from persistence import Persistence, Order, encode_token, decode_token
 from file import File
 from collector.core.filter import Filter
-from sqlalchemy import create_engine, desc, and_, or_, asc
+from sqlalchemy import create_engine, desc, and_, or_, asc, func, text
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy import Column, Integer, String, Sequence, ForeignKey
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import lazyload, joinedload, selectinload
 from sqlalchemy.pool import StaticPool
+from textindex import tokenize
+from cache import LRUCache
+from config import Config
+from timeit import default_timer
+import logging
 import os
+import re
+import threading
 
 
 class FilterSQLAlchemy(Filter):
@@ -70,6 +80,32 @@ class FilterLike(FilterSQLAlchemy):
         return query
 
 
+class FilterIn(FilterSQLAlchemy):
+    """The membership filter, the value must be a list"""
+
+    @staticmethod
+    def get_id():
+        return 'in'
+
+    @staticmethod
+    def get_description():
+        return "Looks if a value is one of a list"
+
+    @staticmethod
+    def get_name():
+        return "in"
+
+    @staticmethod
+    def filter(params):
+        """Builds the query filter"""
+        if not isinstance(params, list) or len(params) != 3:
+            raise ValueError()
+        left = params[1]
+        right = params[2]
+        query = getattr(params[0], left).in_(right)
+        return query
+
+
 class FileAlchemy(File):
     """File is a group of fields"""
 
@@ -143,12 +179,110 @@ class FileAlchemy(File):
         return out
 
 
+class StatementProfiler(object):
+    """Times the SQL statements of the engines, the statements are
+     aggregated by their normalized text (without literals and with the
+     IN lists collapsed). The statements slower than *threshold* seconds
+     are logged."""
+
+    # Maximum number of raw statements whose normalized text is cached
+    CACHE_SIZE = 1000
+
+    LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+    SPACES = re.compile(r"\s+")
+
+    def __init__(self, threshold=None):
+        super(StatementProfiler, self).__init__()
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._stats = {}
+        # raw statement -> normalized statement
+        self._normalized = LRUCache(self.CACHE_SIZE)
+
+    def attach(self, engine):
+        """Listens the statements executed by the *engine*"""
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        # The start is kept by the execution context, the connection is
+        #  shared by the threads (StaticPool)
+        if context is not None:
+            context._profiler_start = default_timer()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        start = getattr(context, '_profiler_start', None)
+        if start is not None:
+            self.record(statement, default_timer() - start)
+
+    @classmethod
+    def normalize(cls, statement):
+        """Returns the statement without literals, IN lists and extra
+         whitespace"""
+        statement = cls.LITERALS.sub('?', statement)
+        statement = cls.IN_LIST.sub('IN (?...)', statement)
+        return cls.SPACES.sub(' ', statement).strip()
+
+    def record(self, statement, seconds):
+        """Adds the execution of the statement"""
+        if self.threshold and seconds >= self.threshold:
+            logging.warning("Slow query (%.3fs): %s", seconds,
+                            self.SPACES.sub(' ', statement).strip())
+        with self._lock:
+            key = self._normalized.get(statement)
+            if key is None:
+                key = self.normalize(statement)
+                self._normalized.put(statement, key)
+            stat = self._stats.get(key, None)
+            if stat is None:
+                stat = {'statement': key, 'calls': 0, 'seconds': 0.0,
+                        'max': 0.0}
+                self._stats[key] = stat
+            stat['calls'] += 1
+            stat['seconds'] += seconds
+            stat['max'] = max(stat['max'], seconds)
+
+    def top(self, count=10, key='seconds'):
+        """Returns the *count* statements with more *key* (seconds, calls
+         or max)"""
+        with self._lock:
+            stats = [dict(stat) for stat in self._stats.values()]
+        for stat in stats:
+            stat['mean'] = stat['seconds'] / stat['calls']
+        stats.sort(key=lambda stat: stat[key], reverse=True)
+        return stats[:count]
+
+    def report(self, count=10, key='seconds'):
+        """Returns the top statements as text"""
+        lines = ["%10s %8s %10s %10s  %s" % ('seconds', 'calls', 'mean',
+                                             'max', 'statement')]
+        for stat in self.top(count, key):
+            lines.append("%10.4f %8d %10.6f %10.6f  %s" % (
+                stat['seconds'], stat['calls'], stat['mean'], stat['max'],
+                stat['statement']))
+        return '\n'.join(lines)
+
+    def clear(self):
+        """Removes the statistics"""
+        with self._lock:
+            self._stats.clear()
+            self._normalized.clear()
+
+
 class Alchemy(object):
     """Alchemy connects the PersistenceAlchemy with the sessions
      of SQLAlchemy"""
 
     _instance = None
+    # The collections can be opened by several threads
+    _lock = threading.RLock()
     echo = False
+    # SQLite settings that can be tuned, in the order that are set
+    PRAGMAS = ('busy_timeout', 'journal_mode', 'synchronous', 'cache_size',
+               'mmap_size', 'temp_store')
 
     def __init__(self):
         super(Alchemy, self).__init__()
@@ -157,15 +291,24 @@ class Alchemy(object):
         Alchemy._instance = self
         self.engine = {}
         self.session = {}
+        # Lock of each session, the session isn't thread safe
+        self.locks = {}
+        config = Config.get_instance()
+        # Timing of the statements of all the engines
+        self.profiler = None
+        if config.get('sql_profile'):
+            self.profiler = StatementProfiler(config.get('sql_slow_query'))
+        # Declarative base of each DB, the tables of a collection
+        #  don't clash with the tables of the others
+        self.bases = {}
         self.classes = {}
         self.filters = self._create_filters()
-        self.base = declarative_base()
 
     @classmethod
     def _create_filters(cls):
         """Creates the default avaible filters for SQLAlchemy"""
         filters = {}
-        for i in [FilterEquals, FilterLike]:
+        for i in [FilterEquals, FilterLike, FilterIn]:
             filters[i.get_id()] = i()
         return filters
 
@@ -177,30 +320,80 @@ class Alchemy(object):
     @staticmethod
     def get_instance():
         """Returns the alchemy instance"""
-        if Alchemy._instance is None:
-            Alchemy._instance = Alchemy()
+        with Alchemy._lock:
+            if Alchemy._instance is None:
+                Alchemy._instance = Alchemy()
         return Alchemy._instance
 
-    def get_engine(self, key):
-        """Rertuns the sqlalchemy engine, for the requested DB"""
-        if not key in self.engine:
-            self.engine[key] = create_engine(
-                'sqlite:///' + key,
-                # TODO provar suport mysql
-                #"mysql://root@localhost/collector",
-                connect_args={'check_same_thread': False},
-                poolclass=StaticPool,
-                echo=Alchemy.echo)
+    def get_engine(self, key, pragmas=None):
+        """Rertuns the sqlalchemy engine, for the requested DB. The
+         *pragmas* {name: value} are set on each new connection, they
+         are only used when the engine is created."""
+        with self._lock:
+            if not key in self.engine:
+                self.engine[key] = create_engine(
+                    'sqlite:///' + key,
+                    # TODO provar suport mysql
+                    #"mysql://root@localhost/collector",
+                    connect_args={'check_same_thread': False},
+                    poolclass=StaticPool,
+                    echo=Alchemy.echo)
+                if self.profiler is not None:
+                    self.profiler.attach(self.engine[key])
+                if pragmas:
+                    self._set_pragmas(self.engine[key], pragmas)
         return self.engine[key]
 
+    @staticmethod
+    def _set_pragmas(engine, pragmas):
+        """Executes the PRAGMA statements on every connection of the
+         engine, raises a ValueError if a pragma isn't supported"""
+        statements = []
+        for name in Alchemy.PRAGMAS:
+            if name not in pragmas:
+                continue
+            value = pragmas[name]
+            if not isinstance(value, (int, long)) and \
+                    not re.match(r'^[A-Za-z]+$', str(value)):
+                raise ValueError("Wrong value %s for PRAGMA %s" %
+                                 (value, name))
+            statements.append("PRAGMA %s=%s" % (name, value))
+        unknown = set(pragmas) - set(Alchemy.PRAGMAS)
+        if unknown:
+            raise ValueError("PRAGMA not supported: %s" %
+                             ', '.join(sorted(unknown)))
+
+        def connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.close()
+        event.listen(engine, 'connect', connect)
+
+    def get_base(self, key):
+        """Returns the declarative base for the requested DB"""
+        with self._lock:
+            if not key in self.bases:
+                self.bases[key] = declarative_base()
+        return self.bases[key]
+
     def get_session(self, key):
         """Returns the session for the requested DB"""
         if not key in self.engine:
             raise Exception("key not found")
-        if not key in self.session:
-            self.session[key] = sessionmaker(bind=self.engine[key])()
+        with self._lock:
+            if not key in self.session:
+                self.session[key] = sessionmaker(bind=self.engine[key])()
         return self.session[key]
 
+    def get_lock(self, key):
+        """Returns the lock of the session for the requested DB, all the
+         persistences of the DB use the same session"""
+        with self._lock:
+            if not key in self.locks:
+                self.locks[key] = threading.RLock()
+        return self.locks[key]
+
     def get_filter(self, key):
         """Returns the requested filter"""
         return self.filters[key]
@@ -214,6 +407,37 @@ def _multivalue_table_init(self, k):
 class PersistenceAlchemy(Persistence):
 
     """PersistenceAlchemy"""
+
+    # Maximum number of ids in a SQL IN clause (sqlite allows 999 params)
+    IN_CHUNK = 500
+    # Loading strategies for the reference and multivalue relations
+    LOADERS = {
+        'lazy': lazyload,
+        'joined': joinedload,
+        'selectin': selectinload
+    }
+    # SQLite tuning profiles (pragmas), choosen with the param
+    #  *sqlite_profile*, the param *sqlite* overrides single pragmas
+    PROFILES = {
+        # The SQLite defaults
+        'default': {},
+        # Write ahead log, readers don't block the writer
+        'wal': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -65536,
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY',
+            'busy_timeout': 5000
+        },
+        # WAL without losing transactions on a power failure
+        'safe': {
+            'journal_mode': 'WAL',
+            'synchronous': 'FULL',
+            'busy_timeout': 5000
+        }
+    }
+
     def __init__(self, schema, path, params=None):
         super(PersistenceAlchemy, self).__init__(
             schema,
@@ -225,16 +449,93 @@ class PersistenceAlchemy(Persistence):
             file_path = path
         # echo is useful for debug
         self.man = Alchemy.get_instance()
-        self.engine = self.man.get_engine(file_path)
+        self.engine = self.man.get_engine(file_path, self.pragmas())
+        self.base = self.man.get_base(file_path)
         self._assoc = []
 
         attributes = self.get_columns(schema)
         self.class_ = type(str(schema.collection + "_" + schema.id),
-                           (FileAlchemy, self.man.base), attributes)
+                           (FileAlchemy, self.base), attributes)
         self._session = self.man.get_session(file_path)
+        self._lock = self.man.get_lock(file_path)
+        # Name of the full text table, None if FTS5 is not avaible
+        self._fts = None
+        # Default loading strategy and the cache of loader options
+        self.loading = (self.params or {}).get('loading', 'selectin')
+        self._loaders = {}
+
+    def pragmas(self):
+        """Returns the SQLite pragmas choosen by the params"""
+        params = self.params or {}
+        profile = params.get('sqlite_profile', 'default')
+        if profile not in self.PROFILES:
+            raise ValueError("SQLite profile %s not found" % profile)
+        pragmas = dict(self.PROFILES[profile])
+        pragmas.update(params.get('sqlite', {}))
+        return pragmas
 
     def all_created(self):
-        self.man.base.metadata.create_all(self.engine)
+        self.base.metadata.create_all(self.engine)
+        self._create_fts()
+
+    def fts_columns(self):
+        """Returns the fields indexed by the full text search, only the
+         single value text fields are columns of the schema table"""
+        return sorted([field.get_id() for field in self.schema.file.values()
+                       if field.class_ == 'text' and
+                       not field.is_multivalue()])
+
+    def _create_fts(self):
+        """Creates the FTS5 table of the schema and the triggers that
+         keep it in sync with the schema table"""
+        columns = self.fts_columns()
+        if not columns:
+            return
+        table = self.subcollection
+        fts = table + '_fts'
+        cols = ', '.join(columns)
+        new = ', '.join(['new.' + i for i in columns])
+        old = ', '.join(['old.' + i for i in columns])
+        try:
+            with self.engine.begin() as conn:
+                result = conn.execute("PRAGMA table_info(%s)" % fts)
+                current = []
+                if result.returns_rows:
+                    current = [row[1] for row in result]
+                if current == columns:
+                    self._fts = fts
+                    return
+                if current:
+                    # The schema has changed
+                    conn.execute("DROP TABLE %s" % fts)
+                for trigger in ['ai', 'ad', 'au']:
+                    conn.execute("DROP TRIGGER IF EXISTS %s_%s" %
+                                 (fts, trigger))
+                conn.execute(
+                    "CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s',"
+                    " content_rowid='id')" % (fts, cols, table))
+                conn.execute(
+                    "CREATE TRIGGER %s_ai AFTER INSERT ON %s BEGIN"
+                    " INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END" %
+                    (fts, table, fts, cols, new))
+                conn.execute(
+                    "CREATE TRIGGER %s_ad AFTER DELETE ON %s BEGIN"
+                    " INSERT INTO %s(%s, rowid, %s)"
+                    " VALUES ('delete', old.id, %s); END" %
+                    (fts, table, fts, fts, cols, old))
+                conn.execute(
+                    "CREATE TRIGGER %s_au AFTER UPDATE ON %s BEGIN"
+                    " INSERT INTO %s(%s, rowid, %s)"
+                    " VALUES ('delete', old.id, %s);"
+                    " INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END" %
+                    (fts, table, fts, fts, cols, old, fts, cols, new))
+                # Index the existing rows
+                conn.execute("INSERT INTO %s(%s) VALUES ('rebuild')" %
+                             (fts, fts))
+            self._fts = fts
+        except OperationalError as error:
+            logging.warning("PersistenceAlchemy: full text search not "
+                            "avaible for %s: %s", table, error)
 
     def next_id(self):
         """Returns the new id to insert in the table"""
@@ -244,9 +545,41 @@ class PersistenceAlchemy(Persistence):
             max_id = 1
         return max_id + 1
 
-    def filter(self, filters):
+    def filter(self, filters, loading=None):
         query = self.build_filter_query(filters)
-        return self._session.query(self.class_).filter(query).all()
+        return self._query(loading).filter(query).all()
+
+    def _query(self, loading=None):
+        """Returns a query of the entries that loads the reference and
+         multivalue relations with the *loading* strategy: 'lazy',
+         'selectin' or 'joined'. By default the persistence param
+         'loading' or 'selectin'."""
+        return self._session.query(self.class_).options(
+            *self.load_options(loading))
+
+    def load_options(self, loading=None):
+        """Returns the loader options for the relations of the schema,
+         with 'selectin' a page of entries is loaded with a query for
+         each relation instead of a query for each entry"""
+        if loading is None:
+            loading = self.loading
+        if loading not in self._loaders:
+            if loading not in self.LOADERS:
+                raise ValueError("Unknown loading strategy %s" % loading)
+            loader = self.LOADERS[loading]
+            options = []
+            for field in self.schema.file.values():
+                if not (field.class_ == 'ref' or field.is_multivalue()):
+                    continue
+                relation = getattr(self.class_, field.get_id() + '_relation')
+                option = loader(relation)
+                if field.class_ == 'ref' and field.is_multivalue():
+                    # Multivalue references: entry -> values -> referenced
+                    assoc = relation.property.mapper.class_
+                    option = getattr(option, loader.__name__)(assoc.ref)
+                options.append(option)
+            self._loaders[loading] = options
+        return self._loaders[loading]
 
     def build_filter_query(self, filters):
         """Builds a query filter"""
@@ -254,7 +587,7 @@ class PersistenceAlchemy(Persistence):
         alchemy = Alchemy.get_instance()
         for filter_ in filters:
             for i in filter_:
-                if i in alchemy.filters and i in ['equals', 'like']:
+                if i in alchemy.filters and i in ['equals', 'like', 'in']:
                     params = [self.class_]
                     params.extend(filter_[i])
                     clause = alchemy.get_filter(i).filter(
@@ -281,15 +614,17 @@ class PersistenceAlchemy(Persistence):
 
         for field in schema.file.values():
             id_ = field.get_id()
-            value = Column(String)
+            indexed = schema.is_indexed(id_)
+            value = Column(String, index=indexed)
             if field.class_ == 'int':
-                value = Column(Integer)
+                value = Column(Integer, index=indexed)
             elif field.class_ == 'long':
-                value = Column(Integer)
+                value = Column(Integer, index=indexed)
             elif field.class_ == 'ref':
                 value = Column(
                     Integer,
-                    ForeignKey(field.ref_collection + '.id')
+                    ForeignKey(field.ref_collection + '.id'),
+                    index=indexed
                 )
                 # Many to one:
                 # without backref: [boardgames] * ---> 1 [designers]
@@ -334,7 +669,7 @@ class PersistenceAlchemy(Persistence):
                         cascade="delete"
                     )
                 ref_table = type(assoc_table,
-                                 (self.man.base,), assoc_attr)
+                                 (self.base,), assoc_attr)
 
                 columns[id_ + '_relation'] = relationship(ref_table)
                 columna = association_proxy(id_ + '_relation', 'value')
@@ -346,8 +681,74 @@ class PersistenceAlchemy(Persistence):
     def get(self, _id):
         return self._session.query(self.class_).get(_id)
 
-    def get_all(self, start_at, limit, order):
-        query = self._session.query(self.class_)
+    def get_all(self, start_at, limit, order, loading=None):
+        query = self._ordered_query(order, loading)
+        query = query.offset(start_at)
+        if limit == 0:
+            return query.all()
+        else:
+            return query.limit(limit).all()
+
+    def iter_all(self, batch_size=100, order=None, loading=None):
+        """Generator of all the entries, the rows are fetched from the
+         database in batches of *batch_size*"""
+        if (loading or self.loading) == 'joined':
+            # Joined collections can't be loaded in batches
+            loading = 'selectin'
+        query = self._ordered_query(order, loading)
+        for obj in query.yield_per(batch_size):
+            yield obj
+
+    def get_page(self, token=None, limit=100, order=None, loading=None):
+        """Returns a page of entries and the token of the next page. The
+         pages are filtered by the last (key, id) of the previous page
+         instead of using an offset, so deep pages are as fast as
+         the first one."""
+        last = None
+        if token is not None:
+            last = decode_token(token, order)
+        id_ = self.class_.id
+        if order is None:
+            query = self._query(loading).order_by(asc(id_))
+            if last is not None:
+                query = query.filter(id_ > last['id'])
+        else:
+            if not isinstance(order, Order):
+                raise ValueError("Expected Order found %s" % type(order))
+            column = getattr(self.class_, order.fields)
+            direction = asc if order.asc else desc
+            query = self._query(loading).order_by(
+                direction(column), direction(id_))
+            if last is not None:
+                query = query.filter(
+                    self._after_key(column, last['key'], last['id'],
+                                    order.asc))
+        items = query.limit(limit + 1).all()
+        if len(items) <= limit:
+            return items, None
+        items = items[:limit]
+        key = None
+        if order is not None:
+            key = getattr(items[-1], order.fields)
+        return items, encode_token(order, key, items[-1].id)
+
+    def _after_key(self, column, key, last_id, ascending):
+        """Returns the clause for the rows after (*key*, *last_id*),
+         sqlite sorts the NULL values as the smallest ones"""
+        id_ = self.class_.id
+        if ascending:
+            if key is None:
+                return or_(and_(column.is_(None), id_ > last_id),
+                           column.isnot(None))
+            return or_(column > key, and_(column == key, id_ > last_id))
+        if key is None:
+            return and_(column.is_(None), id_ < last_id)
+        return or_(column < key, and_(column == key, id_ < last_id),
+                   column.is_(None))
+
+    def _ordered_query(self, order, loading=None):
+        """Returns the query of all the entries sorted by *order*"""
+        query = self._query(loading)
         if order is not None:
             if not isinstance(order, Order) and not isinstance(order, unicode):
                 raise ValueError("Expected Order or unicode found %s",
@@ -358,24 +759,35 @@ class PersistenceAlchemy(Persistence):
                 else:
                     order = desc(order.fields)
             query = query.order_by(order)
-        query = query.offset(start_at)
-        if limit == 0:
-            return query.all()
-        else:
-            return query.limit(limit).all()
+        return query
 
     def get_filters(self):
         return Alchemy.get_instance().filters
 
-    def get_last(self, count):
-        return self._session.query(self.class_).order_by(
+    def get_last(self, count, loading=None):
+        return self._query(loading).order_by(
             desc(self.class_.id)
-        ).limit(count)
-
-    def search(self, term):
-        return self._session.query(self.class_).filter(
-            getattr(self.class_, self.schema.default).contains(term)
-        ).all()
+        ).limit(count).all()
+
+    def search(self, term, loading=None):
+        """Returns the entries with text fields that contains all the
+         words of *term*, the words could be incomplete. If FTS5 is
+         avaible the results are ranked, the best first."""
+        if self._fts is None:
+            return self._query(loading).filter(
+                getattr(self.class_, self.schema.default).contains(term)
+            ).all()
+        terms = tokenize(term)
+        if not terms:
+            return self._query(loading).all()
+        match = ' '.join(['"%s"*' % i.replace('"', '""') for i in terms])
+        ids = [row[0] for row in self._session.execute(
+            text("SELECT rowid FROM %s WHERE %s MATCH :match ORDER BY rank" %
+                 (self._fts, self._fts)),
+            {'match': match})]
+        objs = dict([(obj.id, obj)
+                     for obj in self._query_ids(ids, loading)])
+        return [objs[i] for i in ids if i in objs]
 
     def save(self, values):
         if isinstance(values, self.class_):
@@ -395,12 +807,90 @@ class PersistenceAlchemy(Persistence):
             self._session.commit()
         return obj
 
+    def save_many(self, values):
+        """Saves all the values in one transaction, returns the id of each
+         entry or None for the updates of missing entries. The new entries
+         and their multivalue rows get their id before the insert so they
+         are inserted in batches."""
+        values = list(values)
+        session = self._session
+        updates = {}
+        for item in values:
+            if isinstance(item, self.class_):
+                continue
+            elif not isinstance(item, dict):
+                raise ValueError("Expected dict")
+            if 'id' in item:
+                item['id'] = int(item['id'])
+                updates[item['id']] = None
+        for obj in self._query_ids(updates.keys()):
+            updates[obj.id] = obj
+        next_id = (session.query(func.max(self.class_.id)).scalar() or 0) + 1
+        ids = []
+        changed = []
+        for item in values:
+            if isinstance(item, self.class_):
+                ids.append(item.id)
+                continue
+            if 'id' in item:
+                obj = updates[item['id']]
+                if obj is None:
+                    ids.append(None)
+                    continue
+                obj.update(item)
+            else:
+                item['id'] = next_id
+                next_id += 1
+                obj = self.class_(item)
+                session.add(obj)
+            changed.append(obj)
+            ids.append(item['id'])
+        self._number_rows(changed)
+        session.commit()
+        return ids
+
+    def _number_rows(self, objs):
+        """Sets the id of the new multivalue rows of *objs*, without it
+         each row is inserted by its own statement to read its id"""
+        session = self._session
+        for field in self.schema.file.values():
+            if not field.is_multivalue():
+                continue
+            name = field.get_id() + '_relation'
+            table = getattr(self.class_, name).property.mapper.class_
+            # The rows must not be flushed before they have an id
+            with session.no_autoflush:
+                rows = [row for obj in objs for row in getattr(obj, name)
+                        if row.id is None]
+                if not rows:
+                    continue
+                next_id = (session.query(func.max(table.id)).scalar() or
+                           0) + 1
+            for row in rows:
+                row.id = next_id
+                next_id += 1
+
+    def _query_ids(self, ids, loading='lazy'):
+        """Returns the objects whit identifier in *ids*, the ids are
+         queried in chunks to keep the number of SQL parameters low"""
+        ids = list(ids)
+        query = self._query(loading)
+        for i in range(0, len(ids), self.IN_CHUNK):
+            chunk = ids[i:i + self.IN_CHUNK]
+            for obj in query.filter(self.class_.id.in_(chunk)):
+                yield obj
+
     def delete(self, id_):
         obj = self._session.query(self.class_).get(id_)
         if not obj is None:
             self._session.delete(obj)
             self._session.commit()
 
+    def delete_many(self, ids):
+        for obj in list(self._query_ids(ids)):
+            self._session.delete(obj)
+        self._session.commit()
+
     def load_references(self, collections, item):
         """Loads all the referenced values using sqlalchemy relations"""
         if '_refLoaded' in item:
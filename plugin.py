@@ -3,7 +3,9 @@
 
 from abc import ABCMeta, abstractproperty, abstractmethod
 from provider import UrlProvider
+from storage import JSONStorage
 import glob
+import imp
 import os
 import sys
 import logging
@@ -91,6 +93,9 @@ class PluginManager(object):
     """Manager for the plugin system"""
 
     _instance = None
+    # Name of the manifest of the plug-ins files, in the config folder
+    MANIFEST = 'plugins'
+    MANIFEST_VERSION = 2
 
     def __init__(self, enabled=None, plugins=None, paths=None):
         """PluginManager manages the avaible, enable/disable and discover
@@ -115,6 +120,8 @@ class PluginManager(object):
 
         self.paths = []
         self.plugins = plugins
+        # id -> manifest entry of the plug-ins not yet imported
+        self._available = {}
         self.look_for_plugins(paths)
 
     @staticmethod
@@ -127,50 +134,138 @@ class PluginManager(object):
 
     def look_for_plugins(self, paths):
         """Discovers all the plug-ins that exists in all the paths received
-         as argument"""
+         as argument. The plug-ins are imported when they are used, the
+         manifest keeps the identifier and class of each plug-in file so
+         they are imported only once to be discovered. The files that fail
+         to import aren't kept, they are tried again on the next
+         discovery."""
         # Append existing non existing paths to self.paths
         self.paths.extend([path for path in paths if path not in self.paths])
+        manifest = self._load_manifest()
+        changed = False
         # Look for new plug-ins
         for path in paths:
             f_path = os.path.abspath(path)
-            pyfiles = glob.glob(os.path.join(f_path, '*.py'))
-            # register pyfile in sys.path
-            if len(pyfiles) > 0 and not f_path in sys.path:
-                sys.path.append(f_path)
-            # import the plugin
-            for i in pyfiles:
+            for i in glob.glob(os.path.join(f_path, '*.py')):
                 try:
-                    module = os.path.basename(i)[:-3]
-                    classname = 'Plugin' + module.capitalize()
-                    temp = __import__(module,
-                                      globals(), locals(),
-                                      fromlist=[classname])
-                    class_definition = getattr(temp, classname)
-                    if issubclass(class_definition, Plugin):
-                        logging.info("PluginManager: discovered plug-in %s",
-                                     module)
-                        plugin = class_definition()
-                        self.register_plugin(plugin)
-                        # Auto-execute plug-ins
-                        if (issubclass(class_definition, PluginRunnable) and
-                                plugin.get_id() in self.enabled and
-                                plugin.autorun()):
-                            plugin.run()
+                    mtime = os.path.getmtime(i)
+                    entry = manifest.get(i, None)
+                    if entry is None or entry['mtime'] != mtime:
+                        entry = self._discover(i, mtime)
+                        if entry is None:
+                            manifest.pop(i, None)
+                            continue
+                        manifest[i] = entry
+                        changed = True
+                    if entry['id'] is None:
+                        continue
+                    if entry['id'] not in self.plugins:
+                        self._available[entry['id']] = entry
+                    # Auto-execute plug-ins
+                    if (entry['autorun'] and
+                            entry['id'] in self.enabled):
+                        self.get(entry['id']).run()
                 except Exception as e:
                     logging.exception(e)
+        if changed:
+            self._save_manifest(manifest)
+
+    def _discover(self, filename, mtime):
+        """Imports the plug-in file and returns its manifest entry, the
+         entry of a file without plug-in has no *id*. Returns None if the
+         plug-in can't be imported or created (e.g. a missing dependency),
+         it's tried again on the next discovery."""
+        module = os.path.basename(filename)[:-3]
+        entry = {'mtime': mtime, 'module': module, 'file': filename,
+                 'class': 'Plugin' + module.capitalize(),
+                 'id': None, 'autorun': False}
+        try:
+            class_definition = self._import(entry)
+            if isinstance(class_definition, type) and \
+                    issubclass(class_definition, Plugin):
+                logging.info("PluginManager: discovered plug-in %s",
+                             module)
+                plugin = class_definition()
+                self.register_plugin(plugin)
+                entry['id'] = plugin.get_id()
+                entry['autorun'] = (isinstance(plugin, PluginRunnable) and
+                                    plugin.autorun())
+        except Exception as e:
+            logging.warning("PluginManager: can't load %s: %s",
+                            filename, e)
+            return None
+        return entry
+
+    @staticmethod
+    def _import(entry):
+        """Imports the plug-in module from the file of the manifest
+         *entry* and returns the plug-in class, None if the module hasn't
+         it"""
+        f_path = os.path.dirname(entry['file'])
+        # register pyfile in sys.path, the plug-in can import its modules
+        if not f_path in sys.path:
+            sys.path.append(f_path)
+        temp = imp.load_source(entry['module'], entry['file'])
+        return getattr(temp, entry['class'], None)
+
+    def _manifest_storage(self):
+        """Returns the storage of the plug-ins manifest"""
+        config = Config.get_instance()
+        return JSONStorage(os.path.join(config.get_home(), 'config'),
+                           self.MANIFEST)
+
+    def _load_manifest(self):
+        """Returns the manifest {file: entry} of the plug-ins files"""
+        try:
+            manifest = self._manifest_storage().load()
+        except Exception as e:
+            logging.exception(e)
+            manifest = None
+        if manifest is None or \
+                manifest.get('version', None) != self.MANIFEST_VERSION:
+            return {}
+        return manifest['plugins']
+
+    def _save_manifest(self, manifest):
+        """Stores the manifest, the removed files are discarded"""
+        manifest = dict((key, value) for key, value in manifest.items()
+                        if os.path.exists(key))
+        try:
+            self._manifest_storage().save(
+                {'version': self.MANIFEST_VERSION, 'plugins': manifest})
+        except Exception as e:
+            logging.exception(e)
 
     def is_enabled(self, _id):
         """Checks if the plugin *_id* is enabled and if it was returns True"""
         return _id in self.enabled
 
     def get(self, _id):
-        """Returns the plugin with identifier _id"""
+        """Returns the plugin with identifier _id, the plug-in is imported
+         the first time"""
+        if _id not in self.plugins and _id in self._available:
+            entry = self._available[_id]
+            if not os.path.exists(entry['file']):
+                del self._available[_id]
+                raise KeyError("The file %s of the plug-in %s doesn't "
+                               "exist" % (entry['file'], _id))
+            logging.info("PluginManager: loading plug-in %s", _id)
+            class_definition = self._import(entry)
+            if class_definition is None:
+                del self._available[_id]
+                raise KeyError("The file %s hasn't the plug-in %s" %
+                               (entry['file'], _id))
+            self.register_plugin(class_definition())
         return self.plugins[_id]
 
+    def is_available(self, _id):
+        """Checks if the plug-in *_id* exists, loaded or not"""
+        return _id in self.plugins or _id in self._available
+
     def filter(self, subclass):
         """Returns all the plugins that implements the subclass"""
         return [i for i in self.enabled
-                if isinstance(self.plugins[i], subclass)]
+                if self.is_available(i) and isinstance(self.get(i), subclass)]
 
     def get_enabled(self):
         """Returns a list of all the enabled plug-ins"""
@@ -178,9 +273,13 @@ class PluginManager(object):
 
     def get_disabled(self):
         """Returns a list with all the disabled plug-ins"""
-        return [plugin for plugin in self.plugins
+        return [plugin for plugin in self.get_available()
                 if plugin not in self.enabled]
 
+    def get_available(self):
+        """Returns a list with the identifiers of all the plug-ins"""
+        return list(set(self.plugins.keys()) | set(self._available.keys()))
+
     def enable(self, pluginlist):
         """Turns on all the plug-ins of *pluginlist*, *pluginlist* must be a
          *list* of identifiers."""
@@ -189,7 +288,7 @@ class PluginManager(object):
         logging.info("Enabling plug-ins %s", pluginlist)
         for i in pluginlist:
             # Check if plug-in exists and is not yet enabled
-            if i in self.plugins and i not in self.enabled:
+            if self.is_available(i) and i not in self.enabled:
                 self.enabled.append(i)
 
     def disable(self, pluginlist):
@@ -197,12 +296,13 @@ class PluginManager(object):
         if not isinstance(pluginlist, list):
             raise TypeError()
         for i in pluginlist:
-            if i in self.plugins and i in self.enabled:
+            if self.is_available(i) and i in self.enabled:
                 self.enabled.remove(i)
 
     def register_plugin(self, plugin):
         """Add to the available plug-ins the plug-in received as argument"""
         self.plugins[plugin.get_id()] = plugin
+        self._available.pop(plugin.get_id(), None)
 
     def save(self):
         """Save the enabled plugins using config"""
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling
+---------
+
+Measures the phases of the startup: wall clock time and, optionally,
+ allocations. The allocations are the memory (bytes) traced by
+ *tracemalloc* when it's tracing, otherwise the difference of live objects
+ tracked by the garbage collector (python 2 hasn't *tracemalloc*), it can
+ be negative and walks the whole heap, so it's disabled by default.
+"""
+from contextlib import contextmanager
+import cProfile
+import gc
+import json
+import logging
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _tracing():
+    """Checks if tracemalloc is avaible and tracing"""
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def allocations():
+    """Returns the current value of the allocations counter: traced bytes
+     or live objects"""
+    if _tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return len(gc.get_objects())
+
+
+class StartupProfile(object):
+    """Timings of the startup phases, each phase is a dict with the keys
+     *name*, *seconds* and, if *allocations* is True, *allocations*"""
+
+    def __init__(self, allocations=False):
+        super(StartupProfile, self).__init__()
+        self.phases = []
+        self.allocations = False
+        self.unit = None
+        self._profiler = None
+        if allocations:
+            self.enable_allocations()
+
+    def enable_allocations(self):
+        """Measures the allocations of the next phases"""
+        self.allocations = True
+        self.unit = 'bytes' if _tracing() else 'live object delta'
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager that measures the phase *name*, the allocations
+         counter isn't included in the time"""
+        allocated = allocations() if self.allocations else None
+        start = time.time()
+        try:
+            yield
+        finally:
+            phase = {'name': name, 'seconds': time.time() - start}
+            if allocated is not None:
+                phase['allocations'] = allocations() - allocated
+            self.phases.append(phase)
+
+    def start_profiler(self):
+        """Profiles with cProfile the next phases, see *dump_stats*"""
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop_profiler(self):
+        """Stops the profiler, if it's running"""
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    def dump_stats(self, filename):
+        """Writes the pstats of the profiled phases to *filename*"""
+        if self._profiler is None:
+            raise ValueError("The profiler wasn't started")
+        self.stop_profiler()
+        self._profiler.dump_stats(filename)
+
+    def total(self):
+        """Returns the seconds of all the phases"""
+        return sum(phase['seconds'] for phase in self.phases)
+
+    def as_dict(self):
+        """Returns the profile as a dict, ready to be serialized"""
+        return {'unit': self.unit, 'total': self.total(),
+                'phases': [dict(phase) for phase in self.phases]}
+
+    def log(self):
+        """Writes the profile as a JSON log line"""
+        logging.info("Startup profile: %s", json.dumps(self.as_dict()))
@@ -15,6 +15,8 @@ class Schema(object):
         self.name = None
         self.file = {}
         self.order = []
+        # Identifiers of the fields that must be indexed
+        self.indexes = []
         # TODO icona e imatge per defecte
         self.ico = None
         self.image = None
@@ -33,14 +35,21 @@ class Schema(object):
         """Rerturns the field with the requested identifier"""
         return self.file[identifier]
 
+    def is_indexed(self, identifier):
+        """Checks if the field with the requested identifier is indexed"""
+        return identifier in self.indexes
+
     def read_params(self, config):
         """Loads schema values from a python dictionary"""
         self.name = config['name']
         fields = config['fields']
         self.file = {}
+        self.indexes = []
         manager = FieldManager.get_instance()
         for field in fields.items():
             self.file[field[0]] = manager.get(field[1])
+            if field[1].get('index', False):
+                self.indexes.append(field[0])
 
         if 'order' in config:
             self.order = []
@@ -5,6 +5,15 @@ import pickle
 import json
 import os
 import logging
+import threading
+
+
+def _replace(src, dst):
+    """Renames *src* to *dst* overriding it, windows doesn't allow
+     to rename over an existing file"""
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
 
 
 class FileStorage(object):
@@ -75,6 +84,18 @@ class JSONStorage(FileStorage):
         file_.close()
 
 
+class AtomicJSONStorage(JSONStorage):
+    """JSON storage that replaces the file atomically, an interrupted save
+     keeps the previous content"""
+
+    def do_save(self, obj):
+        tmp = self.file + ".tmp"
+        file_ = open(tmp, 'wb')
+        json.dump(obj, file_)
+        file_.close()
+        _replace(tmp, self.file)
+
+
 class PickleStorage(FileStorage):
     """Implementation of a storage using Pickle"""
 
@@ -91,3 +112,177 @@ class PickleStorage(FileStorage):
         file_ = open(self.file, 'wb')
         pickle.dump(obj, file_,)
         file_.close()
+
+
+class JSONJournalStorage(JSONStorage):
+    """JSON storage for lists of items (dicts with an *id*) where the
+     changes are appended to a journal instead of rewriting the whole file.
+    The JSON file is a snapshot, the journal is compacted into it when
+     it grows over *threshold* records; the compaction runs in a background
+     thread if *background* is True."""
+
+    def __init__(self, path, name, readonly=False, threshold=1000,
+                 background=True):
+        super(JSONJournalStorage, self).__init__(path, name, readonly)
+        self.journal = os.path.join(self.path, name + ".journal")
+        self.threshold = threshold
+        self.background = background
+        self.records = 0
+        # Bytes of the journal, the compaction keeps the records after
+        #  the ones folded into the snapshot
+        self.size = 0
+        self._lock = threading.Lock()
+        self._compactor = None
+
+    def load(self):
+        """Returns the snapshot with all the journal records applied"""
+        items = super(JSONJournalStorage, self).load()
+        if items is None:
+            items = []
+        self.records = 0
+        self.size = 0
+        if os.path.exists(self.journal):
+            items = self._replay(items)
+        return items
+
+    def _replay(self, items):
+        """Applies the journal records to the list of *items*, a broken
+         last record (interrupted write) is removed from the journal"""
+        positions = {}
+        for pos, item in enumerate(items):
+            positions[item['id']] = pos
+        file_ = open(self.journal, 'rb')
+        broken = False
+        line = ''
+        for line in file_:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A broken line can only be the last one (interrupted write)
+                logging.warning("STORAGE ignoring broken journal record %s",
+                                self.journal)
+                broken = True
+                break
+            self.records += 1
+            self.size += len(line)
+            if record['op'] == 'save':
+                item = record['item']
+                if item['id'] in positions:
+                    items[positions[item['id']]] = item
+                else:
+                    positions[item['id']] = len(items)
+                    items.append(item)
+            elif record['op'] == 'delete':
+                pos = positions.pop(record['id'], None)
+                if pos is not None:
+                    items[pos] = None
+        file_.close()
+        if broken and not self.readonly:
+            # The next records would be appended to the broken line
+            file_ = open(self.journal, 'r+b')
+            file_.truncate(self.size)
+            file_.close()
+        elif line and not line.endswith('\n') and not self.readonly:
+            # Complete record without the line end
+            file_ = open(self.journal, 'ab')
+            file_.write('\n')
+            file_.close()
+            self.size += 1
+        return [item for item in items if item is not None]
+
+    def append(self, records):
+        """Appends the *records* to the journal, a record is a dict like
+         {'op': 'save', 'item': item} or {'op': 'delete', 'id': id}.
+        Returns True when the journal must be compacted."""
+        if self.readonly:
+            return False
+        lines = ''.join([json.dumps(record) + '\n' for record in records])
+        with self._lock:
+            self.create_path()
+            file_ = open(self.journal, 'ab')
+            file_.write(lines)
+            self.size = file_.tell()
+            file_.close()
+            self.records += len(records)
+        return self.records >= self.threshold
+
+    def save(self, obj):
+        """Stores *obj* as the new snapshot and empties the journal"""
+        if self.readonly:
+            return
+        self.wait()
+        with self._lock:
+            self.create_path()
+            self._write_snapshot(obj)
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+            self.records = 0
+            self.size = 0
+
+    def compact(self, items):
+        """Folds the journal into a new snapshot of *items*"""
+        if self.readonly or self.compacting():
+            return
+        # Items are copied here, they could change while the snapshot is
+        #  written by the background thread
+        items = [item.copy() for item in items]
+        with self._lock:
+            done = (self.records, self.size)
+        if self.background:
+            self._compactor = threading.Thread(
+                target=self._compact, args=(items, done),
+                name="compact-" + self.name)
+            self._compactor.start()
+        else:
+            self._compact(items, done)
+
+    def compacting(self):
+        """Returns True if a background compaction is running"""
+        return self._compactor is not None and self._compactor.is_alive()
+
+    def wait(self):
+        """Waits until the background compaction (if any) finishes"""
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    def _compact(self, items, done):
+        """Writes the snapshot and keeps only the journal records appended
+         after the *done* ones, a tuple (records, bytes)"""
+        records, size = done
+        try:
+            tmp = self.file + ".tmp"
+            self._dump(items, tmp)
+            with self._lock:
+                tail = ''
+                if os.path.exists(self.journal):
+                    file_ = open(self.journal, 'rb')
+                    file_.seek(size)
+                    tail = file_.read()
+                    file_.close()
+                journal_tmp = self.journal + ".tmp"
+                file_ = open(journal_tmp, 'wb')
+                file_.write(tail)
+                file_.close()
+                # Replaying an old journal over a new snapshot is harmless
+                #  so the order of the renames is safe
+                _replace(tmp, self.file)
+                _replace(journal_tmp, self.journal)
+                self.records -= records
+                self.size -= size
+            logging.info("STORAGE compacted %s", self.file)
+        except (IOError, OSError) as error:
+            logging.exception(error)
+
+    def _write_snapshot(self, obj):
+        """Atomically replaces the snapshot file"""
+        tmp = self.file + ".tmp"
+        self._dump(obj, tmp)
+        _replace(tmp, self.file)
+
+    @staticmethod
+    def _dump(obj, filename):
+        """Writes the snapshot into *filename*"""
+        file_ = open(filename, 'wb')
+        json.dump(obj, file_)
+        file_.close()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Text index
+----------
+
+An inverted index for the full text search of the files. Each text is
+ split in tokens and for each token the index keeps the identifiers of the
+ files that contains it (the posting list).
+"""
+from bisect import bisect_left, insort
+import math
+import re
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Returns the list of lowercase tokens of the text"""
+    if text is None:
+        return []
+    if isinstance(text, str):
+        # Byte strings are UTF-8, all the tokens must be unicode to be
+        #  compared
+        text = text.decode('utf-8', 'replace')
+    elif not isinstance(text, unicode):
+        text = unicode(text)
+    return TOKEN.findall(text.lower())
+
+
+class TextIndex(object):
+    """Inverted index updated incrementally, the queries are answered
+     intersecting the posting lists of the query terms"""
+
+    def __init__(self):
+        super(TextIndex, self).__init__()
+        # token -> {id: occurrences}
+        self.postings = {}
+        # id -> tokens, needed to remove or update a file
+        self.documents = {}
+        # sorted tokens, allows prefix queries
+        self.vocabulary = []
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, id_, texts):
+        """Indexes the list of *texts* of the file *id_*, if the file was
+         indexed before the old tokens are replaced"""
+        if id_ in self.documents:
+            self.remove(id_)
+        tokens = []
+        for text in texts:
+            tokens.extend(tokenize(text))
+        self.documents[id_] = tokens
+        for token in tokens:
+            posting = self.postings.get(token, None)
+            if posting is None:
+                posting = self.postings[token] = {}
+                insort(self.vocabulary, token)
+            posting[id_] = posting.get(id_, 0) + 1
+
+    def remove(self, id_):
+        """Removes the file *id_* from the index"""
+        tokens = self.documents.pop(id_, None)
+        if tokens is None:
+            return
+        for token in set(tokens):
+            posting = self.postings[token]
+            del posting[id_]
+            if not posting:
+                del self.postings[token]
+                pos = bisect_left(self.vocabulary, token)
+                del self.vocabulary[pos]
+
+    def _expand(self, term):
+        """Returns the tokens that starts with term"""
+        tokens = []
+        pos = bisect_left(self.vocabulary, term)
+        while (pos < len(self.vocabulary) and
+               self.vocabulary[pos].startswith(term)):
+            tokens.append(self.vocabulary[pos])
+            pos += 1
+        return tokens
+
+    def search(self, query):
+        """Returns the ids of the files that contains all the terms of the
+         query, each term matches the tokens that starts with it. The
+         results are ranked by relevance (tf-idf), the best first. Returns
+         None if the query doesn't have any term."""
+        terms = set(tokenize(query))
+        if not terms:
+            return None
+        total = float(len(self.documents))
+        matches = []
+        for term in terms:
+            scores = {}
+            for token in self._expand(term):
+                posting = self.postings[token]
+                idf = math.log(1 + total / len(posting))
+                for id_, count in posting.items():
+                    scores[id_] = scores.get(id_, 0) + count * idf
+            if not scores:
+                return []
+            matches.append(scores)
+        # Intersect starting with the shortest posting list
+        matches.sort(key=len)
+        ranking = matches[0]
+        for scores in matches[1:]:
+            ranking = dict([(id_, score + scores[id_])
+                            for id_, score in ranking.items()
+                            if id_ in scores])
+            if not ranking:
+                return []
+        return sorted(ranking, key=lambda id_: (-ranking[id_], id_))